@@ -0,0 +1,63 @@
+"""
+Startup benchmark of `mdanalysis.correlate`. Every measurement runs in a fresh
+interpreter: the import of mdanalysis, and the first call of a Legendre kernel
+with a cold and with a warm on-disk cache
+
+Usage: python benchmarks/correlate_startup.py [n_repeats]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+IMPORT_SNIPPET = """
+import sys, time
+time_0 = time.perf_counter()
+import mdanalysis
+print(time.perf_counter() - time_0, 'numba' in sys.modules)
+"""
+
+FIRST_CALL_SNIPPET = """
+import time
+import numpy as np
+import mdanalysis
+data = np.random.random((200, 3))
+time_0 = time.perf_counter()
+correlate = mdanalysis.prepare_numba_correlation(mdanalysis.prepare_legendre(2))
+correlate(data, 1.0)
+print(time.perf_counter() - time_0)
+"""
+
+
+def run(snippet, cache_dir):
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    output = subprocess.run([sys.executable, '-c', snippet], env=env, check=True,
+                            capture_output=True, text=True).stdout
+    return output.split()
+
+
+def main():
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for i in range(n_repeats):
+            import_time, numba_loaded = run(IMPORT_SNIPPET, cache_dir)
+            print("import mdanalysis: {:.3f} s, numba imported: {:s}".format(float(import_time), numba_loaded))
+
+        for i in range(n_repeats):
+            shutil.rmtree(cache_dir)
+            os.makedirs(cache_dir)
+            cold = float(run(FIRST_CALL_SNIPPET, cache_dir)[0])
+            warm = float(run(FIRST_CALL_SNIPPET, cache_dir)[0])
+            print("first kernel call: cold cache {:.3f} s, warm cache {:.3f} s".format(cold, warm))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
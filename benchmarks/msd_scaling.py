@@ -0,0 +1,43 @@
+"""
+Strong scaling benchmark of the numba engine of `lammpstools.mdt.msd_raw`.
+Runs the direct msd on a synthetic random walk with 1 to N threads
+
+Usage: python benchmarks/msd_scaling.py [n_frames] [n_atoms] [spacing]
+"""
+
+import sys
+import time
+
+import numba
+import numpy as np
+
+from lammpstools.mdt import msd_raw
+
+
+def main():
+    n_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    n_atoms = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    spacing = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    upper = n_frames // 10
+
+    rng = np.random.default_rng(0)
+    xyz = np.cumsum(rng.normal(scale=0.01, size=(n_frames, n_atoms, 3)), axis=0).astype(np.float32)
+
+    # Compile outside of the timed region
+    msd_raw(xyz[:10], 1, 1, upper=2, engine='numba')
+
+    print("frames = {:d}, atoms = {:d}, spacing = {:d}, upper = {:d}".format(n_frames, n_atoms, spacing, upper))
+    print("{:>8s} {:>10s} {:>8s}".format("threads", "time [s]", "speedup"))
+    serial = None
+    for n_threads in range(1, numba.config.NUMBA_NUM_THREADS+1):
+        numba.set_num_threads(n_threads)
+        time_0 = time.perf_counter()
+        msd_raw(xyz, 1, None, spacing=spacing, upper=upper, engine='numba')
+        elapsed = time.perf_counter() - time_0
+        if serial is None:
+            serial = elapsed
+        print("{:8d} {:10.3f} {:8.2f}".format(n_threads, elapsed, serial/elapsed))
+
+
+if __name__ == "__main__":
+    main()
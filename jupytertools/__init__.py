@@ -1,3 +1,5 @@
 """Initializing package jupytertools"""
 
 from .utilities import *
+from .arraystore import *
+from .decimation import *
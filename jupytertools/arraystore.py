@@ -0,0 +1,253 @@
+"""Chunked storage of numpy arrays as an alternative to shelve files
+
+Every store is a folder with one subfolder per key. Arrays are split along the first axis
+into chunks saved as `.npy` files, which can be memory-mapped, or as zlib compressed raw
+bytes. Only the chunks overlapping a requested slice are read. Objects other than numpy
+arrays are pickled
+"""
+
+import json
+import os
+import pickle
+import shutil
+import zlib
+from os.path import join, isdir, isfile
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+
+__all__ = ['save_to_store', 'save_dict_to_store', 'retrieve_from_store', 'retrieve_dict_from_store',
+           'print_content_of_store', 'iter_store_chunks', 'StoredArray']
+
+
+_default_chunk_bytes = 64*1024**2
+
+
+class StoredArray:
+    """Array saved in a store that is read only when indexed. Indexing with a slice or
+    integers along the first axis reads only the chunks that are needed
+
+    Parameters
+    ----------
+    path : folder of the stored key
+    mmap : whether to memory-map uncompressed chunks instead of reading them
+    """
+    def __init__(self, path, mmap=False):
+        self.path = path
+        self.mmap = mmap
+        with open(join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.shape = tuple(self.meta['shape'])
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.chunk_length = self.meta['chunk_length']
+        self.n_chunks = self.meta['n_chunks']
+
+    def __repr__(self):
+        return f"{type(self).__name__}(shape={self.shape}, dtype={self.dtype}, path='{self.path}')"
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        first, rest = index[0], index[1:]
+
+        if isinstance(first, (int, np.integer)):
+            if first < 0:
+                first += self.shape[0]
+            if not 0 <= first < self.shape[0]:
+                raise IndexError(f"Index {index[0]} is out of bounds for axis 0 with size {self.shape[0]}")
+            chunk = self.read_chunk(first // self.chunk_length)
+            return chunk[(first % self.chunk_length,) + rest]
+
+        if self.n_chunks == 1:
+            return self.read_chunk(0)[index]
+
+        if isinstance(first, slice):
+            rows = np.arange(*first.indices(self.shape[0]))
+        else:
+            rows = np.arange(self.shape[0])[first]
+
+        if rows.size == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+
+        # Every chunk is read once, the rows are put back in the requested order afterwards
+        chunk_ids = rows // self.chunk_length
+        order = np.argsort(chunk_ids, kind='stable')
+        chunk_ids, sorted_rows = chunk_ids[order], rows[order]
+        starts = np.flatnonzero(np.diff(chunk_ids, prepend=-1))
+        parts = []
+        for start, stop in zip(starts, np.append(starts[1:], rows.size)):
+            i_chunk = chunk_ids[start]
+            in_chunk = sorted_rows[start:stop] - i_chunk*self.chunk_length
+            parts.append(self.read_chunk(i_chunk)[(in_chunk,) + rest])
+
+        result = np.concatenate(parts)
+        if np.all(order[1:] > order[:-1]):
+            return result
+        return result[np.argsort(order)]
+
+    def read_chunk(self, i_chunk):
+        """Read a single chunk, memory-mapped if the store is not compressed and mmap is set"""
+        if self.meta['compression'] is None:
+            return np.load(join(self.path, f"chunk_{i_chunk:06d}.npy"), mmap_mode='r' if self.mmap else None)
+
+        chunk_shape = (min(self.chunk_length, self.shape[0] - i_chunk*self.chunk_length),) + self.shape[1:]
+        with open(join(self.path, f"chunk_{i_chunk:06d}.zlib"), 'rb') as chunk_file:
+            data = zlib.decompress(chunk_file.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(chunk_shape).copy()
+
+    def iter_chunks(self):
+        for i_chunk in range(self.n_chunks):
+            yield self.read_chunk(i_chunk)
+
+
+def _key_path(filename, key, foldername):
+    return join(foldername, filename, quote(key, safe=''))
+
+
+def _write_key(path, value, chunk_length, compress):
+    # Quoted keys never contain '%' followed by a non-hex character
+    tmp_path = path + '%tmp'
+    if isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    if isinstance(value, np.ndarray) and value.dtype != object and value.ndim > 0:
+        if chunk_length is None:
+            row_bytes = max(1, value[:1].nbytes)
+            chunk_length = max(1, _default_chunk_bytes // row_bytes)
+        n_chunks = max(1, -(-value.shape[0] // chunk_length))
+
+        for i_chunk in range(n_chunks):
+            chunk = np.ascontiguousarray(value[i_chunk*chunk_length:(i_chunk+1)*chunk_length])
+            if compress:
+                with open(join(tmp_path, f"chunk_{i_chunk:06d}.zlib"), 'wb') as chunk_file:
+                    chunk_file.write(zlib.compress(chunk.data, compress if compress is not True else 6))
+            else:
+                np.save(join(tmp_path, f"chunk_{i_chunk:06d}.npy"), chunk)
+
+        meta = {'kind': 'array', 'shape': list(value.shape), 'dtype': value.dtype.str,
+                'chunk_length': chunk_length, 'n_chunks': n_chunks,
+                'compression': 'zlib' if compress else None}
+    else:
+        with open(join(tmp_path, 'value.pkl'), 'wb') as value_file:
+            pickle.dump(value, value_file, protocol=4)
+        meta = {'kind': 'pickle'}
+
+    with open(join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    # Swap the complete new folder in place of the old one
+    old_path = path + '%old'
+    if isdir(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    if isdir(old_path):
+        shutil.rmtree(old_path)
+
+
+def save_to_store(filename, key, value, foldername='store', chunk_length=None, compress=False):
+    """Save the key and value pair into the store with given name. Only the folder
+    of the given key is rewritten.
+
+    Parameters
+    ----------
+    filename : name of the store to be updated or created
+    key : key of the value used when retrieving the value from the store
+    value : the object to be stored, numpy arrays are chunked, other objects pickled
+    chunk_length : number of rows along the first axis in one chunk, by default chunks
+        have about 64 MB
+    compress : compress the chunks with zlib, either True or the compression level.
+        Compressed chunks cannot be memory-mapped
+    """
+    os.makedirs(join(foldername, filename), exist_ok=True)
+    _write_key(_key_path(filename, key, foldername), value, chunk_length, compress)
+
+
+def save_dict_to_store(filename, dictionary, foldername='store', chunk_length=None, compress=False):
+    """Save the entire dictionary to disk as a store. See `save_to_store` for the parameters"""
+    for key, value in dictionary.items():
+        save_to_store(filename, key, value, foldername, chunk_length, compress)
+
+
+def retrieve_from_store(filename, key, foldername='store', index=None, lazy=False, mmap=False):
+    """Retrieve the object stored in the store with given key.
+
+    Parameters
+    ----------
+    filename : name of the store where the object is stored
+    key : key of the object stored in the store
+    index : index or slice of the array to read, only the needed chunks are read
+    lazy : return a `StoredArray` that reads the data only when indexed
+    mmap : memory-map uncompressed chunks instead of reading them
+
+    Returns
+    -------
+    stored_object: python object stored in the given store under the
+        specified key
+    """
+    path = _key_path(filename, key, foldername)
+    if not isdir(path):
+        raise KeyError(key)
+
+    if isfile(join(path, 'value.pkl')):
+        with open(join(path, 'value.pkl'), 'rb') as value_file:
+            value = pickle.load(value_file)
+        return value if index is None else value[index]
+
+    array = StoredArray(path, mmap=mmap)
+    if lazy and index is None:
+        return array
+    return array[:] if index is None else array[index]
+
+
+def iter_store_chunks(filename, key, foldername='store', mmap=True):
+    """Iterate over the chunks of an array stored in the store"""
+    path = _key_path(filename, key, foldername)
+    if not isdir(path):
+        raise KeyError(key)
+    return StoredArray(path, mmap=mmap).iter_chunks()
+
+
+def _store_keys(filename, foldername):
+    store_path = join(foldername, filename)
+    return [unquote(name) for name in os.listdir(store_path)
+            if isdir(join(store_path, name)) and not name.endswith(('%tmp', '%old'))]
+
+
+def retrieve_dict_from_store(filename, foldername='store'):
+    """Retrieve an entire store as a dictionary.
+
+    Parameters
+    ----------
+    filename : name of the store
+
+    Returns
+    -------
+    result_dict: dictionary of key value pairs saved in the store
+    """
+    return {key: retrieve_from_store(filename, key, foldername) for key in _store_keys(filename, foldername)}
+
+
+def print_content_of_store(filename, foldername='store'):
+    """Print all keys of a given store.
+
+    Parameters
+    ----------
+    filename : name of the store
+    """
+    print("Keys in store `{:s}`:".format(filename))
+    for name in sorted(_store_keys(filename, foldername)):
+        print(name)
@@ -0,0 +1,186 @@
+"""Downsampling of long series before plotting them"""
+
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+
+__all__ = ['log_decimate', 'lttb_decimate', 'decimate', 'decimate_cached', 'decimate_cf',
+           'clear_decimation_cache']
+
+
+_decimation_cache = OrderedDict()
+_decimation_cache_size = 256
+
+
+def log_decimate(x, y, n_points):
+    """Keep approximately n_points points logarithmically spaced in the index. Suitable
+    for plots with a logarithmic x axis. The first and the last point are always kept
+
+    Parameters
+    ----------
+    x : x values of the series
+    y : y values of the series
+    n_points : approximate number of points to keep
+
+    Returns
+    -------
+    x, y : decimated series
+
+    """
+    n_values = len(y)
+    if n_points >= n_values:
+        return x, y
+
+    indices = np.unique(np.geomspace(1, n_values, n_points).astype(np.int64) - 1)
+    return x[indices], y[indices]
+
+
+def lttb_decimate(x, y, n_points):
+    """Keep n_points points selected with the largest-triangle-three-buckets algorithm,
+    which preserves the visual shape of the series on linear axes. The first and the last
+    point are always kept
+
+    Parameters
+    ----------
+    x : x values of the series
+    y : y values of the series
+    n_points : number of points to keep, at least 3
+
+    Returns
+    -------
+    x, y : decimated series
+
+    """
+    n_values = len(y)
+    if n_points >= n_values or n_points < 3:
+        return x, y
+
+    x_float = np.asarray(x, dtype=np.float64)
+    y_float = np.asarray(y, dtype=np.float64)
+
+    # Points between the first and the last one are split into n_points-2 buckets
+    edges = np.linspace(1, n_values-1, n_points-1).astype(np.int64)
+    indices = np.empty(n_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n_values-1
+
+    selected = 0
+    for i_bucket in range(n_points-2):
+        start, stop = edges[i_bucket], edges[i_bucket+1]
+        if i_bucket < n_points-3:
+            x_next = x_float[stop:edges[i_bucket+2]].mean()
+            y_next = y_float[stop:edges[i_bucket+2]].mean()
+        else:
+            x_next = x_float[-1]
+            y_next = y_float[-1]
+
+        x_sel, y_sel = x_float[selected], y_float[selected]
+        areas = np.abs((x_sel - x_next)*(y_float[start:stop] - y_sel)
+                       - (x_sel - x_float[start:stop])*(y_next - y_sel))
+        selected = start + np.argmax(areas)
+        indices[i_bucket+1] = selected
+
+    return x[indices], y[indices]
+
+
+def decimate(x, y, mode='log', n_points=2000):
+    """Decimate series with the given mode, either 'log' or 'lttb'. If mode is None the
+    series is returned unchanged"""
+    if mode is None:
+        return x, y
+
+    x, y = np.asarray(x), np.asarray(y)
+    if mode == 'log':
+        return log_decimate(x, y, n_points)
+    elif mode == 'lttb':
+        return lttb_decimate(x, y, n_points)
+    else:
+        raise ValueError(f"Unknown decimation mode {mode}")
+
+
+def decimate_cached(x, y, mode='log', n_points=2000, refs=None, extra_key=()):
+    """Same as `decimate`, but the result is cached so that redrawing the same series
+    is instant. The cache is keyed on the identity of the objects in refs (x and y by
+    default) together with extra_key. Only weak references to them are kept, an entry is
+    dropped once any of them is garbage collected. Objects that cannot be weakly referenced
+    (e.g. lists) are not cached. Arrays modified in place return stale results, call
+    `clear_decimation_cache` after such modification
+
+    Parameters
+    ----------
+    x : x values of the series
+    y : y values of the series
+    mode : decimation mode, see `decimate`
+    n_points : number of points to keep
+    refs : objects whose identity determines the cached series, (x, y) by default
+    extra_key : additional hashable key, for instance the time step of the series
+
+    Returns
+    -------
+    x, y : decimated series
+
+    """
+    if mode is None:
+        return x, y
+
+    if refs is None:
+        refs = (x, y)
+
+    key = _cache_key(refs, tuple(extra_key) + (mode, n_points))
+    result = _cache_lookup(key, refs)
+    if result is None:
+        result = decimate(x, y, mode, n_points)
+        _cache_store(key, refs, result)
+    return result
+
+
+def decimate_cf(cf, mode='log', n_points=2000):
+    """Decimated time axis and average of a `CorrelationFunction`, cached per cf"""
+    y = cf.average_cf
+    if mode is None:
+        return cf.time_axis, y
+
+    # average_cf is cached by the cf, so its identity changes only when the cf does
+    refs = (y,) if cf.time_axis_var is None else (y, cf.time_axis_var)
+    key = _cache_key(refs, (cf.dt, mode, n_points))
+    result = _cache_lookup(key, refs)
+    if result is None:
+        result = decimate(cf.time_axis, y, mode, n_points)
+        _cache_store(key, refs, result)
+    return result
+
+
+def _cache_key(refs, extra_key):
+    return tuple(id(ref) for ref in refs) + extra_key
+
+
+def _cache_lookup(key, refs):
+    entry = _decimation_cache.get(key)
+    # Identity check guards against reuse of ids of garbage collected objects
+    if entry is None or not all(cached() is ref for cached, ref in zip(entry[0], refs)):
+        return None
+
+    _decimation_cache.move_to_end(key)
+    return entry[1]
+
+
+def _cache_store(key, refs, result):
+    def drop(_, key=key):
+        _decimation_cache.pop(key, None)
+
+    try:
+        weak_refs = tuple(weakref.ref(ref, drop) for ref in refs)
+    except TypeError:
+        return
+
+    # Only the decimated result is held strongly, not the source series
+    _decimation_cache[key] = (weak_refs, result)
+    if len(_decimation_cache) > _decimation_cache_size:
+        _decimation_cache.popitem(last=False)
+
+
+def clear_decimation_cache():
+    """Drop all cached decimated series"""
+    _decimation_cache.clear()
@@ -2,3 +2,4 @@
 
 from .styling import *
 from .data_plots import *
+from ..decimation import *
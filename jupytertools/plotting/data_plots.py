@@ -2,6 +2,7 @@
 
 import matplotlib.pyplot as plt
 from .styling import save_to_disk
+from ..decimation import decimate_cached, decimate_cf
 from mdanalysis import get_time_axis_like
 
 
@@ -9,7 +10,11 @@ __all__ = ['plot_all', 'plot_cfs']
 
 
 def plot_all(dictionary, keys_sorted=True, keys=None, xlim=None, ylim=None, x_label='', y_label='',
-             title='', dt=1, style=None, filename=None, save=False, **kwargs):
+             title='', dt=1, style=None, filename=None, save=False, decimate=None, n_points=2000,
+             **kwargs):
+    """Plot all series in the dictionary. Values are either tuples (x, y) or only y, in which
+    case the time axis is created from dt. Long series can be decimated before plotting with
+    decimate='log' (for logarithmic x axis) or decimate='lttb', keeping about n_points points"""
     if save:
         if filename is None:
             print("To save, you must specify file name")
@@ -31,10 +36,15 @@ def plot_all(dictionary, keys_sorted=True, keys=None, xlim=None, ylim=None, x_la
     for name in sorted_name_list:
         try:
             x, y = dictionary[name]
+            x, y = decimate_cached(x, y, decimate, n_points)
             plt.plot(x, y, label=name, **style)
         except ValueError:
             y = dictionary[name]
-            x = get_time_axis_like(y, dt)
+            if decimate is None:
+                x = get_time_axis_like(y, dt)
+            else:
+                x, y = decimate_cached(get_time_axis_like(y, dt), y, decimate, n_points,
+                                       refs=(y,), extra_key=(dt,))
             plt.plot(x, y, label=name, **style)
 
     for func_name, argument in kwargs.items():
@@ -58,7 +68,10 @@ def plot_all(dictionary, keys_sorted=True, keys=None, xlim=None, ylim=None, x_la
 
 
 def plot_cfs(dictionary, keys_sorted=True, xlim=None, ylim=None, xlabel='', ylabel='', style=None,
-             legend=True, title='', filename=None):
+             legend=True, title='', filename=None, decimate=None, n_points=2000):
+    """Plot averages of the cfs in the dictionary. Long cfs can be decimated before plotting
+    with decimate='log' (for logarithmic x axis) or decimate='lttb', keeping about n_points
+    points. The decimated cfs are cached, so redrawing them is fast"""
     if keys_sorted:
         name_list = sorted(dictionary.keys())
     else:
@@ -69,8 +82,7 @@ def plot_cfs(dictionary, keys_sorted=True, xlim=None, ylim=None, xlabel='', ylab
 
     for name in name_list:
         cff = dictionary[name]
-        y = cff.average_cf
-        x = get_time_axis_like(y, cff.dt)
+        x, y = decimate_cf(cff, decimate, n_points)
         plt.plot(x, y, label=name, **style)
 
     if legend:
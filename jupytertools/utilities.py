@@ -1,14 +1,419 @@
 """Utilities functions for jupyter notebook"""
 
+import atexit
+import fnmatch
+import json
+import os
+import pickle
 import shelve
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from os.path import join
 
+import numpy as np
+
 
 __all__ = ['save_to_shelve', 'save_dict_to_shelve', 'retrieve_from_shelve', 'retrieve_dict_from_shelve',
-           'print_content_of_shelve']
+           'print_content_of_shelve', 'shelve_cache_info', 'clear_shelve_cache', 'set_shelve_cache_size',
+           'flush_shelve_writes', 'read_manifest', 'list_shelve', 'shelve_has_key', 'is_stale']
+
+
+def _shelve_mtime(path):
+    """Latest modification time of the files of the shelve, which depend on the dbm backend"""
+    mtimes = [os.stat(path + suffix).st_mtime_ns for suffix in ['', '.db', '.dat', '.dir']
+              if os.path.exists(path + suffix)]
+    if not mtimes:
+        raise FileNotFoundError(f"No shelve file {path}")
+    return max(mtimes)
+
+
+class ShelveCache:
+    """Read-through cache of objects retrieved from shelve files. Open read-only handles
+    are kept for the recently used files and the unpickled objects are kept in LRU order
+    until their total pickled size exceeds `max_bytes`. Both are invalidated when the
+    modification time of the shelve file changes. Cached numpy arrays are read-only, since
+    the same object is returned on every retrieval
+
+    The save functions of this module close the cached handle of a file before writing it.
+    With the dbm.gnu backend an open handle holds a reader lock, so other processes cannot
+    write the file while it is cached, call `clear_shelve_cache` to release the handles
+    """
+    def __init__(self, max_bytes=1024**3, max_handles=16):
+        self.max_bytes = max_bytes
+        self.max_handles = max_handles
+        self.handles = OrderedDict()
+        self.objects = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def retrieve(self, path, key):
+        with self.lock:
+            mtime = _shelve_mtime(path)
+            entry = self.objects.get((path, key))
+            if entry is not None and entry[0] == mtime:
+                self.objects.move_to_end((path, key))
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            # Reading directly the pickled bytes gives the size of the object for free
+            database = self._handle(path, mtime)
+            try:
+                raw = database.dict[key.encode(database.keyencoding)]
+            except KeyError:
+                # The dbm backends report the encoded key, raise the key itself
+                raise KeyError(key) from None
+            value = pickle.loads(raw)
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+
+            self._discard((path, key))
+            if len(raw) <= self.max_bytes:
+                self.objects[(path, key)] = (mtime, value, len(raw))
+                self.n_bytes += len(raw)
+                while self.n_bytes > self.max_bytes:
+                    self._discard(next(iter(self.objects)))
+            return value
+
+    def _handle(self, path, mtime):
+        entry = self.handles.get(path)
+        if entry is not None and entry[0] == mtime:
+            self.handles.move_to_end(path)
+            return entry[1]
+
+        if entry is not None:
+            entry[1].close()
+        database = shelve.open(path, flag='r')
+        self.handles[path] = (mtime, database)
+        self.handles.move_to_end(path)
+        if len(self.handles) > self.max_handles:
+            _, (_, oldest) = self.handles.popitem(last=False)
+            oldest.close()
+        return database
+
+    def _discard(self, object_key):
+        entry = self.objects.pop(object_key, None)
+        if entry is not None:
+            self.n_bytes -= entry[2]
+
+    def invalidate(self, path):
+        """Drop the handle and all objects of the shelve file"""
+        with self.lock:
+            entry = self.handles.pop(path, None)
+            if entry is not None:
+                entry[1].close()
+            for object_key in [object_key for object_key in self.objects if object_key[0] == path]:
+                self._discard(object_key)
+
+    def clear(self):
+        with self.lock:
+            for _, database in self.handles.values():
+                database.close()
+            self.handles.clear()
+            self.objects.clear()
+            self.n_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'n_objects': len(self.objects),
+                    'n_bytes': self.n_bytes, 'max_bytes': self.max_bytes, 'n_handles': len(self.handles)}
+
+
+_shelve_cache = ShelveCache()
+
+
+def shelve_cache_info():
+    """Return statistics of the cache used by `retrieve_from_shelve` with cache=True
+
+    Returns
+    -------
+    info : dictionary with number of hits and misses, number and total pickled size
+        of the cached objects and number of open handles
+    """
+    return _shelve_cache.info()
+
+
+def clear_shelve_cache():
+    """Close all cached shelve handles, drop all cached objects and reset the statistics"""
+    _shelve_cache.clear()
+
+
+def set_shelve_cache_size(max_bytes):
+    """Set the maximal total pickled size of the objects kept in the shelve cache"""
+    with _shelve_cache.lock:
+        _shelve_cache.max_bytes = max_bytes
+        while _shelve_cache.n_bytes > max_bytes:
+            _shelve_cache._discard(next(iter(_shelve_cache.objects)))
+
+
+class ShelveWriter:
+    """Background writer of shelve files. A single thread writes the submitted items, so
+    the writes to every file are serialised in the order of submission. Items waiting to be
+    written are grouped per file and a repeated write of a waiting key only replaces its
+    value. When `max_pending` keys are waiting, new submissions block until some are written
+    """
+    def __init__(self, max_pending=64):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()
+        self.futures = {}
+        self.n_pending = 0
+        self.writing = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def submit(self, path, items):
+        """Schedule writing of the items (dictionary) to the shelve file, returns a future
+        that completes once they are written. Cancelling the future before the write starts
+        drops its items"""
+        future = Future()
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='shelve-writer', daemon=True)
+                self.thread.start()
+
+            while self.n_pending >= self.max_pending:
+                self.condition.wait()
+
+            batch = self.pending.setdefault(path, {})
+            self.n_pending += sum(1 for key in items if key not in batch)
+            batch.update(items)
+            self.futures.setdefault(path, []).append((future, dict(items)))
+            self.condition.notify_all()
+        return future
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                path, batch = self.pending.popitem(last=False)
+                submitted = self.futures.pop(path)
+                self.writing = path
+
+            try:
+                # Items of futures cancelled while waiting are dropped
+                futures, items = [], {}
+                for future, future_items in submitted:
+                    if future.set_running_or_notify_cancel():
+                        futures.append(future)
+                        items.update(future_items)
+
+                error = None
+                try:
+                    if items:
+                        _write_shelve(path, items)
+                except Exception as exc:
+                    error = exc
+
+                # Futures are resolved before flush can return
+                for future in futures:
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+            finally:
+                with self.condition:
+                    self.n_pending -= len(batch)
+                    self.writing = None
+                    self.condition.notify_all()
+
+    def _busy(self, path):
+        if path is None:
+            return bool(self.pending) or self.writing is not None
+        return path in self.pending or self.writing == path
+
+    def flush(self, path=None):
+        """Wait until all items (of the given file only, if path is specified) are written"""
+        with self.condition:
+            while self._busy(path):
+                self.condition.wait()
+
+
+_shelve_writer = ShelveWriter()
+atexit.register(_shelve_writer.flush)
+
+
+_manifest_lock = threading.RLock()
+
+
+def _manifest_path(path):
+    return path + '.manifest.json'
+
+
+def _manifest_entry(value, n_bytes, timestamp):
+    shape = getattr(value, 'shape', None)
+    dtype = getattr(value, 'dtype', None)
+    return {'type': type(value).__name__,
+            'shape': None if shape is None else list(shape),
+            'dtype': None if dtype is None else str(dtype),
+            'nbytes': n_bytes, 'timestamp': timestamp}
+
+
+def _save_manifest(path, entries):
+    manifest = {'shelve_mtime': _shelve_mtime(path), 'entries': entries}
+    tmp_path = _manifest_path(path) + '.tmp'
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, _manifest_path(path))
+
+
+def _rebuild_manifest(path, old_entries):
+    """List the keys of the shelve file, used only when the manifest is missing or out of
+    date. Values are not unpickled, so type, shape and dtype are unknown (None) except for
+    entries of the old manifest whose size did not change"""
+    timestamp = _shelve_mtime(path) / 1e9
+    entries = {}
+    with shelve.open(path, flag='r') as database:
+        for raw_key in database.dict.keys():
+            key = raw_key.decode(database.keyencoding)
+            n_bytes = len(database.dict[raw_key])
+            old_entry = old_entries.get(key)
+            if old_entry is not None and old_entry['nbytes'] == n_bytes:
+                entries[key] = old_entry
+            else:
+                entries[key] = {'type': None, 'shape': None, 'dtype': None,
+                                'nbytes': n_bytes, 'timestamp': timestamp}
+    _save_manifest(path, entries)
+    return entries
+
+
+def _describe_entries(path, entries):
+    """Fill in type, shape and dtype of the entries rebuilt without unpickling"""
+    unknown = [key for key, entry in entries.items() if entry['type'] is None]
+    if not unknown:
+        return entries
 
+    with shelve.open(path, flag='r') as database:
+        for key in unknown:
+            raw = database.dict[key.encode(database.keyencoding)]
+            entries[key] = _manifest_entry(pickle.loads(raw), len(raw), entries[key]['timestamp'])
+    _save_manifest(path, entries)
+    return entries
 
-def save_to_shelve(filename, key, value, foldername='shelve'):
+
+def _manifest_entries(path):
+    with _manifest_lock:
+        try:
+            with open(_manifest_path(path)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            manifest = None
+
+        try:
+            shelve_mtime = _shelve_mtime(path)
+        except FileNotFoundError:
+            return {}
+
+        # The shelve was modified without updating the manifest
+        if manifest is None or manifest['shelve_mtime'] != shelve_mtime:
+            return _rebuild_manifest(path, {} if manifest is None else manifest['entries'])
+        return manifest['entries']
+
+
+def _write_shelve(path, items):
+    _shelve_cache.invalidate(path)
+    with _manifest_lock:
+        entries = _manifest_entries(path)
+        timestamp = time.time()
+        with shelve.open(path, protocol=4) as database:
+            for key, value in items.items():
+                # Same as database[key] = value, but the size of the pickle is known
+                raw = pickle.dumps(value, protocol=4)
+                database.dict[key.encode(database.keyencoding)] = raw
+                entries[key] = _manifest_entry(value, len(raw), timestamp)
+        _save_manifest(path, entries)
+
+
+def read_manifest(filename, foldername='shelve', details=False):
+    """Return the manifest of the shelve file, which is maintained by the save functions
+    in a sidecar file `<filename>.manifest.json`. Only the manifest is read unless the shelve
+    has no manifest or was modified by other means. Then the manifest is rebuilt from the
+    keys and sizes of the stored pickles, without unpickling them, so type, shape and dtype
+    of the new entries are None until requested with details=True
+
+    Parameters
+    ----------
+    filename : name of the shelve file
+    details : unpickle objects with unknown type, shape and dtype to fill them in
+
+    Returns
+    -------
+    entries : dictionary with key of every stored object and values containing its type,
+        shape and dtype (None for objects without them), pickled size in bytes `nbytes`
+        and `timestamp` of the save
+    """
+    path = join(foldername, filename)
+    _shelve_writer.flush(path)
+    with _manifest_lock:
+        entries = _manifest_entries(path)
+        return _describe_entries(path, entries) if details else entries
+
+
+def list_shelve(filename, foldername='shelve', pattern=None, type_name=None):
+    """List sorted keys of a shelve file from its manifest
+
+    Parameters
+    ----------
+    filename : name of the shelve file
+    pattern : shell-style wildcard pattern the keys have to match, e.g. 'cf_*'
+    type_name : name of the type of the stored objects, e.g. 'ndarray'
+
+    Returns
+    -------
+    keys : list of the matching keys
+    """
+    entries = read_manifest(filename, foldername, details=type_name is not None)
+    return sorted(key for key, entry in entries.items()
+                  if (pattern is None or fnmatch.fnmatchcase(key, pattern))
+                  and (type_name is None or entry['type'] == type_name))
+
+
+def shelve_has_key(filename, key, foldername='shelve'):
+    """Check whether the key is stored in the shelve file using its manifest"""
+    return key in read_manifest(filename, foldername)
+
+
+def is_stale(filename, key, sources=(), foldername='shelve', max_age=None):
+    """Check whether the stored object needs to be recomputed, that is whether it is
+    missing or older than any of the source files or than max_age
+
+    Parameters
+    ----------
+    filename : name of the shelve file
+    key : key of the stored object
+    sources : paths of files the object was computed from, e.g. trajectories
+    max_age : maximal age of the object in seconds, optional
+
+    Returns
+    -------
+    stale : True if the object is missing or out of date
+    """
+    entry = read_manifest(filename, foldername).get(key)
+    if entry is None:
+        return True
+    if max_age is not None and time.time() - entry['timestamp'] > max_age:
+        return True
+    return any(os.path.getmtime(source) > entry['timestamp'] for source in sources)
+
+
+def flush_shelve_writes(filename=None, foldername='shelve'):
+    """Wait until the saves running in background are written to disk. Pending saves are
+    also flushed at interpreter exit
+
+    Parameters
+    ----------
+    filename : name of the shelve file to flush, if None all files are flushed
+    """
+    _shelve_writer.flush(None if filename is None else join(foldername, filename))
+
+
+def save_to_shelve(filename, key, value, foldername='shelve', background=False):
     """Save the key and value pair into shelve file with
     given name. This function assumes that the working directory
     contains folder `shelve` where the shelve files are stored.
@@ -18,12 +423,18 @@ def save_to_shelve(filename, key, value, foldername='shelve'):
     filename : name of the shelve file to be updated or created
     key : key of the value used when retrieving the value from shelve
     value : the object to be stored to the shelve file
+    background : write the value in the background writer thread and return immediately.
+        The value must not be modified until it is written
+
+    Returns
+    -------
+    future : `concurrent.futures.Future` completed when the value is written, only
+        if background is True. Cancelling it before the write starts drops the value
     """
-    with shelve.open(join(foldername, filename), protocol=4) as database:
-        database[key] = value
+    return save_dict_to_shelve(filename, {key: value}, foldername, background)
 
 
-def save_dict_to_shelve(filename, dictionary, foldername='shelve'):
+def save_dict_to_shelve(filename, dictionary, foldername='shelve', background=False):
     """Save the entire dictionary to disk as a shelve file.
     This function assumes that the working directory
     contains folder `shelve` where the shelve files are stored.
@@ -32,12 +443,23 @@ def save_dict_to_shelve(filename, dictionary, foldername='shelve'):
     ----------
     filename : name of the shelve file to be updated or created
     dictionary : dictionary to be stored to the file with given name
+    background : write the dictionary in the background writer thread and return
+        immediately. The values must not be modified until they are written
+
+    Returns
+    -------
+    future : `concurrent.futures.Future` completed when the dictionary is written, only
+        if background is True. Cancelling it before the write starts drops the dictionary
     """
-    with shelve.open(join(foldername, filename), protocol=4) as database:
-        database.update(dictionary)
+    path = join(foldername, filename)
+    if background:
+        return _shelve_writer.submit(path, dict(dictionary))
 
+    _shelve_writer.flush(path)
+    _write_shelve(path, dictionary)
 
-def retrieve_from_shelve(filename, key, foldername='shelve'):
+
+def retrieve_from_shelve(filename, key, foldername='shelve', cache=False):
     """Retrieve the object stored in the file with given key.
     This function assumes that the working directory
     contains folder `shelve` where the shelve files are stored.
@@ -46,17 +468,29 @@ def retrieve_from_shelve(filename, key, foldername='shelve'):
     ----------
     filename : name of the shelve file where the object is stored
     key : key of the object stored in the shelve file
+    cache : keep the file open and the object in memory, so that repeated retrievals
+        are fast. The same object is returned until the file changes, hence it must not
+        be modified (numpy arrays are made read-only). The file stays open until
+        `clear_shelve_cache` is called, which blocks writes from other processes with
+        the dbm.gnu backend
 
     Returns
     -------
     stored_object: python object stored in the given file under the
         specified key
     """
-    with shelve.open(join(foldername, filename)) as database:
-        return database[key]
+    _shelve_writer.flush(join(foldername, filename))
+    if cache:
+        return _shelve_cache.retrieve(join(foldername, filename), key)
+
+    with shelve.open(join(foldername, filename), flag='r') as database:
+        try:
+            return database[key]
+        except KeyError:
+            raise KeyError(key) from None
 
 
-def retrieve_dict_from_shelve(filename, foldername='shelve'):
+def retrieve_dict_from_shelve(filename, foldername='shelve', pattern=None):
     """Retrieve an entire dictionary saved as a shelve file.
     This function assumes that the working directory
     contains folder `shelve` where the shelve files are stored.
@@ -64,31 +498,44 @@ def retrieve_dict_from_shelve(filename, foldername='shelve'):
     Parameters
     ----------
     filename : name of the shelve file
+    pattern : retrieve only keys matching this shell-style wildcard pattern, the keys
+        are found from the manifest without reading the other objects
 
     Returns
     -------
     result_dict: dictionary of key value pairs saved on the disk
         as a shelve file
     """
-    with shelve.open(join(foldername, filename)) as database:
+    _shelve_writer.flush(join(foldername, filename))
+    keys = None if pattern is None else list_shelve(filename, foldername, pattern)
+    with shelve.open(join(foldername, filename), flag='r') as database:
+        if keys is not None:
+            return {key: database[key] for key in keys}
+
         result_dict = {}
         for key, value in database.items():
             result_dict[key] = value
         return result_dict
 
 
-def print_content_of_shelve(filename, foldername='shelve'):
-    """Print all keys of a given shelve file.
+def print_content_of_shelve(filename, foldername='shelve', details=False):
+    """Print all keys of a given shelve file. Only the manifest of the file is read.
     This function assumes that the working directory
     contains folder `shelve` where the shelve files are stored.
 
     Parameters
     ----------
     filename : name of the shelve file
+    details : print also type, shape, dtype and size of the stored objects, which may need
+        to unpickle objects stored without the manifest
     """
     print("Keys in file `{:s}`:".format(filename))
-    with shelve.open("{:s}/{:s}".format(foldername, filename), protocol=4) as database:
-        name_list = list(database.keys())
-        sorted_name_list = sorted(name_list)
-        for name in sorted_name_list:
+    entries = read_manifest(filename, foldername, details=details)
+    for name in sorted(entries):
+        if details:
+            entry = entries[name]
+            shape = "" if entry['shape'] is None else " {}".format(tuple(entry['shape']))
+            dtype = "" if entry['dtype'] is None else " {:s}".format(entry['dtype'])
+            print("{:s}: {:s}{:s}{:s}, {:d} B".format(name, entry['type'], shape, dtype, entry['nbytes']))
+        else:
             print(name)
@@ -3,6 +3,10 @@ Initializing file for package lammpstools
 """
 
 from .histogram import density_hist, plot_density, plot_densities
-from .mdt import load_traj, msd, msd_raw, get_coms
+from .mdt import (load_traj, unwrap, unwrap_stream, msd, msd_raw, msd_raw_parallel, msd_moments,
+                  msd_stream, msd_iterload, msd_multitau, get_coms, get_coms_mols,
+                  get_bond_vectors)
 from .thermo import plot_thermo, normalize
-from .viscosity import stress_acf
+from .viscosity import (stress_acf, stress_acf_multitau, stress_batch, viscosity_bootstrap,
+                        einstein_helfand, helfand_viscosity, GreenKuboStream, green_kubo_file)
+from .multitau import MultiTauCorrelator
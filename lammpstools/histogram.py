@@ -9,14 +9,22 @@ import matplotlib.cm as cm
 import mdtraj as md
 
 
-def density_hist(trajectory, top, chunks=100, atoms='all'):
+def density_hist(trajectory, top=None, chunks=100, atoms='all'):
     """
     Returns histogram in time of positions in z-coordinate from given
     trajectory TODO: Is there need for centers?
+
+    The trajectory is either a filename, which is read with `mdtraj.iterload`,
+    or an already loaded `mdtraj.Trajectory` (for instance memory mapped one
+    returned by `load_traj` with cache), in which case `top` is not needed
     """
-    traj_top = md.load(top)
-    topology = traj_top.topology
-    traj = md.iterload(trajectory, top=topology, chunk=chunks)
+    if isinstance(trajectory, md.Trajectory):
+        topology = trajectory.topology
+        traj = (trajectory.xyz[i:i+chunks] for i in range(0, trajectory.n_frames, chunks))
+    else:
+        traj_top = md.load(top)
+        topology = traj_top.topology
+        traj = (chunk.xyz for chunk in md.iterload(trajectory, top=topology, chunk=chunks))
 
     # Automate edges. Do I need centers?
     edges = np.array([i*0.1 for i in range(0, 150)])
@@ -35,7 +43,7 @@ def density_hist(trajectory, top, chunks=100, atoms='all'):
     time_0 = time.time()
     hists = []
     for chunk in traj:
-        hist, edges = np.histogram(chunk.xyz[:, indicies, 2], bins=edges)
+        hist, edges = np.histogram(chunk[:, indicies, 2], bins=edges)
         hists.append(hist.astype(float) / len(chunk))
 
         time_1 = time.time()
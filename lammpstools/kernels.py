@@ -0,0 +1,36 @@
+"""
+Numba kernels for the heavy loops of lammpstools. The module is imported
+lazily, so that numba is loaded only when a kernel is requested
+"""
+
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True)
+def msd_direct(xyz, origins, correlation, n_contribs):
+    """
+    Accumulate squared displacements from the given origins into
+    `correlation` of shape (n_points, n_atoms) and the number of
+    contributions per lag into `n_contribs` of shape (n_points,), both
+    in place. The loop over atoms is parallelized
+    """
+    n_frames = xyz.shape[0]
+    n_atoms = xyz.shape[1]
+    n_points = correlation.shape[0]
+
+    for origin in origins:
+        upper_pt = min(origin+n_points, n_frames)
+        for lag in range(upper_pt-origin):
+            n_contribs[lag] += 1
+
+    for atom in prange(n_atoms):
+        for origin in origins:
+            upper_pt = min(origin+n_points, n_frames)
+            x_0 = xyz[origin, atom, 0]
+            y_0 = xyz[origin, atom, 1]
+            z_0 = xyz[origin, atom, 2]
+            for frame in range(origin, upper_pt):
+                d_x = xyz[frame, atom, 0] - x_0
+                d_y = xyz[frame, atom, 1] - y_0
+                d_z = xyz[frame, atom, 2] - z_0
+                correlation[frame-origin, atom] += d_x*d_x + d_y*d_y + d_z*d_z
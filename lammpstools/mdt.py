@@ -1,22 +1,215 @@
+import hashlib
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 import mdtraj as md
 
+from .multitau import MultiTauCorrelator
+from .parallel import pool_context
+
 
-def load_traj(trajectory, top, stride=None):
+def load_traj(trajectory, top, stride=None, atom_indices=None, cache=False,
+              cache_dir=None, cache_size=None):
     """
     Load trajectory using `mdtraj.load`
 
     :param str trajectory: Filename of trajectory - for instance .xtc format
     :param str top: Filename of topology - for instance .gro format
+    :param int stride: Read only every stride-th frame
+    :param atom_indices: Indices of atoms to load
+    :param bool cache: If the positions should be cached as a float32 .npy
+    file. Subsequent loads of the same trajectory, stride and atoms return
+    a trajectory with read-only memory mapped `xyz` instead of decoding
+    the trajectory again
+    :param str cache_dir: Folder for the cache, by default `.traj_cache`
+    in the folder of the trajectory
+    :param int cache_size: Maximal size of the cache folder in bytes. Least
+    recently used entries are evicted when the size is exceeded. If not
+    specified, nothing is evicted
     :return: Trajectory object
     :rtype: mdtraj.Trajectory
     """
+    if cache:
+        return _load_traj_cached(trajectory, top, stride, atom_indices, cache_dir, cache_size)
+
     print("Loading trajectories from {:s}".format(trajectory), flush=True)
-    traj = md.load(trajectory, top=top, stride=stride)
+    traj = md.load(trajectory, top=top, stride=stride, atom_indices=atom_indices)
     print("Trajectory loaded", flush=True)
     return traj
 
 
+def _load_traj_cached(trajectory, top, stride, atom_indices, cache_dir, cache_size):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(trajectory)), '.traj_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    key = _traj_cache_key(trajectory, stride, atom_indices)
+    xyz_file = os.path.join(cache_dir, key + '.npy')
+    meta_file = os.path.join(cache_dir, key + '.npz')
+
+    if os.path.exists(xyz_file) and os.path.exists(meta_file):
+        print("Loading cached trajectory {:s}".format(trajectory), flush=True)
+        # Touching the entry marks it as recently used for the eviction
+        os.utime(xyz_file)
+    else:
+        traj = load_traj(trajectory, top, stride=stride, atom_indices=atom_indices)
+        meta = {'time': traj.time}
+        if traj.unitcell_lengths is not None:
+            meta['unitcell_lengths'] = traj.unitcell_lengths
+            meta['unitcell_angles'] = traj.unitcell_angles
+
+        # Write to temporary files first, so that interrupted writes are never
+        # picked up as valid entries
+        np.save(xyz_file + '.tmp.npy', traj.xyz.astype(np.float32, copy=False))
+        np.savez(meta_file + '.tmp.npz', **meta)
+        os.replace(meta_file + '.tmp.npz', meta_file)
+        os.replace(xyz_file + '.tmp.npy', xyz_file)
+
+        if cache_size is not None:
+            _evict_traj_cache(cache_dir, cache_size, keep=key)
+
+    topology = md.load_topology(top)
+    if atom_indices is not None:
+        topology = topology.subset(atom_indices)
+
+    xyz = np.load(xyz_file, mmap_mode='r')
+    with np.load(meta_file) as meta:
+        return md.Trajectory(xyz, topology, time=meta['time'],
+                             unitcell_lengths=meta.get('unitcell_lengths'),
+                             unitcell_angles=meta.get('unitcell_angles'))
+
+
+def _traj_cache_key(trajectory, stride, atom_indices):
+    """
+    Key of the cache entry built from the path, size and modification time of
+    the trajectory, hash of its first MiB and the loading parameters
+    """
+    stat = os.stat(trajectory)
+    digest = hashlib.sha1()
+    with open(trajectory, 'rb') as traj_file:
+        digest.update(traj_file.read(2**20))
+
+    if atom_indices is not None:
+        atom_indices = np.asarray(atom_indices).tolist()
+
+    description = repr((os.path.abspath(trajectory), stat.st_size, stat.st_mtime_ns, stride, atom_indices))
+    digest.update(description.encode())
+    return digest.hexdigest()
+
+
+def _evict_traj_cache(cache_dir, cache_size, keep=None):
+    """Remove least recently used entries until the cache fits into `cache_size` bytes"""
+    entries = []
+    total = 0
+    for fname in os.listdir(cache_dir):
+        if not fname.endswith('.npy') or fname.endswith('.tmp.npy'):
+            continue
+        key = fname[:-len('.npy')]
+        files = [os.path.join(cache_dir, key + ext) for ext in ['.npy', '.npz']]
+        size = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+        entries.append((os.path.getmtime(files[0]), key, files, size))
+        total += size
+
+    for _, key, files, size in sorted(entries):
+        if total <= cache_size:
+            break
+        if key == keep:
+            continue
+        for f in files:
+            if os.path.exists(f):
+                os.remove(f)
+        total -= size
+
+
+def unwrap(xyz, box_vectors, chunk=1000, out=None):
+    """
+    Unwrap positions wrapped into the periodic box, so that the particles
+    move continuously. Frames are processed in chunks and the image offsets
+    are carried across the chunk boundaries. Works for orthorhombic and
+    triclinic boxes
+
+    :param numpy.Array xyz: 3 dimensional array of wrapped positions
+    :param numpy.Array box_vectors: Box vectors of every frame with shape
+    (n_frames, 3, 3), for instance `mdtraj.Trajectory.unitcell_vectors`
+    :param int chunk: Number of frames processed at once
+    :param numpy.Array out: Array to write the unwrapped positions into. It
+    can be `xyz` itself (for instance a writable memmap) to unwrap in place
+    :return: unwrapped positions
+    :rtype: `numpy.Array`
+    """
+    if box_vectors is None:
+        raise ValueError("Unwrapping requires box vectors of the trajectory")
+
+    if out is None:
+        out = np.empty(xyz.shape, dtype=xyz.dtype)
+
+    state = None
+    for begin in range(0, xyz.shape[0], chunk):
+        end = begin+chunk
+        state = _unwrap_chunk(xyz[begin:end], box_vectors[begin:end], state, out[begin:end])
+
+    return out
+
+
+def unwrap_stream(chunks):
+    """
+    Unwrap positions of an iterable of trajectory chunks, for instance from
+    `mdtraj.iterload`, and yield the unwrapped positions of every chunk. The
+    result can be passed directly to `msd_stream`
+
+    :param chunks: Iterable of `mdtraj.Trajectory` chunks or tuples of
+    positions and box vectors
+    """
+    state = None
+    for chunk in chunks:
+        if isinstance(chunk, md.Trajectory):
+            xyz, box_vectors = chunk.xyz, chunk.unitcell_vectors
+        else:
+            xyz, box_vectors = chunk
+
+        if box_vectors is None:
+            raise ValueError("Unwrapping requires box vectors of the trajectory")
+
+        unwrapped = np.empty(xyz.shape, dtype=xyz.dtype)
+        state = _unwrap_chunk(xyz, box_vectors, state, unwrapped)
+        yield unwrapped
+
+
+def _unwrap_chunk(xyz, box_vectors, state, out):
+    """
+    Unwrap a chunk of positions into `out`. The state consists of the last
+    wrapped frame of the previous chunk and its image offset. Returns the
+    state after this chunk
+    """
+    if state is None:
+        previous, offset = xyz[0], np.zeros(xyz.shape[1:], dtype=np.float64)
+    else:
+        previous, offset = state
+
+    displacement = np.diff(xyz, axis=0, prepend=previous[np.newaxis])
+    box_vectors = np.asarray(box_vectors, dtype=np.float64)
+
+    off_diagonal = box_vectors - np.eye(3)*box_vectors
+    if not off_diagonal.any():
+        lengths = np.diagonal(box_vectors, axis1=1, axis2=2)[:, np.newaxis, :]
+        shifts = -np.round(displacement/lengths)*lengths
+    else:
+        fractional = np.einsum('fai,fij->faj', displacement, np.linalg.inv(box_vectors))
+        shifts = -np.einsum('faj,fjk->fak', np.round(fractional), box_vectors)
+
+    offsets = np.cumsum(shifts, axis=0)
+    offsets += offset
+
+    # Keep the wrapped last frame before `out` possibly overwrites it
+    state = (np.array(xyz[-1]), offsets[-1])
+    np.add(xyz, offsets, out=out, casting='unsafe')
+
+    return state
+
+
 def msd(traj, n_origs, atoms='all', average=True):
     """
     Calculate MSD for given trajectory
@@ -113,7 +306,8 @@ def msd_raw_old(xyz, dt, n_origs, average=True, upper=None):
     return x_axis, result
 
 
-def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None):
+def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None,
+            method='direct', engine='numpy'):
     """
     Calculate MSD for given trajectory. Unlike `msd` function,
     this function uses xyz array instead of `mdtraj.Trajectory`. Allowing
@@ -123,6 +317,15 @@ def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None):
     for which msd is to be calculated
     :param int dt: Timestep for the given trajectory
     :param int n_origs: Number of origins to use for the correlation function
+    :param int spacing: Spacing between origins, overrides `n_origs`
+    :param bool average: If the msd should be averaged over all atoms
+    :param float upper: Upper window for the msd
+    :param str method: Either 'direct', which loops over the origins, or
+    'fft', which uses every frame as an origin and computes the msd in
+    O(N log N) time. `n_origs` and `spacing` are ignored by the 'fft' method
+    :param str engine: Engine for the 'direct' method. Either 'numpy' or
+    'numba', which accumulates the msd in place with a compiled kernel
+    parallelized over atoms
     :return: x axis array and msd array
     :rtype: tuple -> `numpy.Array` and `numpy.Array`
     """
@@ -132,18 +335,107 @@ def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None):
     n_points = int(upper/dt)
     n_frames = xyz.shape[0]
     n_atoms = xyz.shape[1]
-    n_contribs = np.zeros((n_points, n_atoms), dtype=np.float64)
-    correlation = np.zeros((n_points, n_atoms), dtype=np.float64)
+
+    if method == 'fft':
+        result = _msd_fft(xyz, n_points)
+        x_axis = np.linspace(0, (n_points-1)*dt, n_points)
+        if average:
+            return x_axis, np.mean(result, axis=1)
+        return x_axis, result
+    elif method != 'direct':
+        raise ValueError("Unknown method {:s} for msd calculation".format(method))
 
     if spacing is not None:
         n_origs = int(n_frames / spacing)
     origins = np.linspace(0, n_frames, n_origs, dtype=int, endpoint=False)
 
-    print_threshold = round(n_origs / 100)
-    i = 0
+    if engine == 'numba':
+        from .kernels import msd_direct
 
-    for origin in origins:
-        if i % print_threshold == 0:
+        correlation = np.zeros((n_points, n_atoms), dtype=np.float64)
+        n_contribs = np.zeros((n_points,), dtype=np.float64)
+        msd_direct(np.asarray(xyz), origins, correlation, n_contribs)
+
+        result = correlation/n_contribs[:, np.newaxis]
+        x_axis = np.linspace(0, (n_points-1)*dt, n_points)
+        if average:
+            return x_axis, np.mean(result, axis=1)
+        return x_axis, result
+    elif engine != 'numpy':
+        raise ValueError("Unknown engine {:s} for msd calculation".format(engine))
+
+    correlation, n_contribs = _msd_accumulate(xyz, origins, n_points, verbose=True)
+
+    result = correlation/n_contribs[:, np.newaxis]
+    x_axis = np.linspace(0, (n_points-1)*dt, n_points)
+
+    if average:
+        return x_axis, np.mean(result, axis=1)
+
+    return x_axis, result
+
+
+def _msd_fft(xyz, n_points, atom_block=None):
+    """
+    All-origins msd of every atom using the windowed FFT algorithm, where
+    msd(m) = S1(m) - 2*S2(m). S2 is the autocorrelation of the positions
+    calculated with FFT and S1 follows from a recursion over squared positions.
+    Returns array of shape (n_points, n_atoms)
+    """
+    n_frames = xyz.shape[0]
+    if n_points > n_frames:
+        raise ValueError("The upper window of {:d} frames is longer than the trajectory "
+                         "with {:d} frames".format(n_points, n_frames))
+
+    n_fft = 2*n_frames
+    n_contribs = np.arange(n_frames, n_frames-n_points, -1, dtype=np.float64)[:, np.newaxis]
+    # Atoms are processed in blocks so that the complex temporary of shape
+    # (n_fft//2+1, block) stays around 128 MB
+    block = max(1, 2**23 // n_fft) if atom_block is None else atom_block
+
+    result = np.empty((n_points, xyz.shape[1]), dtype=np.float64)
+    for first in range(0, xyz.shape[1], block):
+        atoms = slice(first, first+block)
+        # The msd does not depend on the origin of coordinates, removing the mean position
+        # avoids cancellation of S1 and 2*S2 for large absolute coordinates
+        positions = np.asarray(xyz[:, atoms, :], dtype=np.float64)
+        positions = positions - positions.mean(axis=0)
+
+        # Autocorrelation summed over the dimensions, one dimension at a time
+        # to keep the complex temporaries small
+        s2 = np.zeros((n_points, positions.shape[1]), dtype=np.float64)
+        for dim in range(positions.shape[2]):
+            transformed = np.fft.rfft(positions[:, :, dim], n=n_fft, axis=0)
+            power = transformed.real**2 + transformed.imag**2
+            s2 += np.fft.irfft(power, n=n_fft, axis=0)[:n_points]
+
+        squared = (positions**2).sum(axis=2)
+        # Q(m) = 2*sum(D) - sum_{k<m} D(k) - sum_{k<m} D(N-1-k)
+        front = np.cumsum(squared[:n_points-1], axis=0)
+        back = np.cumsum(squared[::-1][:n_points-1], axis=0)
+        s1 = np.empty_like(s2)
+        s1[:] = 2*squared.sum(axis=0)
+        s1[1:] -= front + back
+
+        result[:, atoms] = (s1 - 2*s2) / n_contribs
+
+    return result
+
+
+def _msd_accumulate(xyz, origins, n_points, verbose=False):
+    """
+    Sum squared displacements from the given origins. Returns the summed
+    correlation of shape (n_points, n_atoms) and number of contributions
+    per lag
+    """
+    n_contribs = np.zeros((n_points,), dtype=np.float64)
+    correlation = np.zeros((n_points, xyz.shape[1]), dtype=np.float64)
+
+    n_origs = len(origins)
+    print_threshold = max(1, round(n_origs / 100))
+
+    for i, origin in enumerate(origins):
+        if verbose and i % print_threshold == 0:
             print('\r{: 3d}% calculated'.format(round(i*100/n_origs)),
                   end='', flush=True)
 
@@ -152,11 +444,85 @@ def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None):
         ref = xyz[origin, :, :]
         msd_contr = ((xyz[origin:upper_pt, :, :] - ref)**2).sum(axis=2)
 
-        n_contribs[:msd_contr.shape[0], :msd_contr.shape[1]] += 1
+        n_contribs[:msd_contr.shape[0]] += 1
         correlation[:msd_contr.shape[0], :msd_contr.shape[1]] += msd_contr
-        i += 1
 
-    result = correlation/n_contribs
+    return correlation, n_contribs
+
+
+def _msd_shared_block(shm_name, shape, dtype, origins, n_points):
+    """Worker of `msd_raw_parallel` attaching to the positions in shared memory"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        xyz = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _msd_accumulate(xyz, origins, n_points)
+        del xyz
+    finally:
+        shm.close()
+
+    return result
+
+
+def msd_raw_parallel(xyz, dt, n_origs, spacing=None, average=True, upper=None,
+                     max_workers=None, n_blocks=None):
+    """
+    Calculate MSD the same way as the direct method of `msd_raw`, but with
+    the origins split into blocks evaluated in a process pool. The positions
+    are placed once into shared memory that the workers attach to, instead
+    of pickling them for every block
+
+    :param numpy.Array xyz: 3 dimensional array containing positions of objects
+    for which msd is to be calculated
+    :param int dt: Timestep for the given trajectory
+    :param int n_origs: Number of origins to use for the correlation function
+    :param int spacing: Spacing between origins, overrides `n_origs`
+    :param bool average: If the msd should be averaged over all atoms
+    :param float upper: Upper window for the msd
+    :param int max_workers: Number of worker processes, by default number of CPUs
+    :param int n_blocks: Number of blocks of origins, by default 4 per worker
+    :return: x axis array and msd array
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    if upper is None:
+        upper = xyz.shape[0]*dt
+
+    n_points = int(upper/dt)
+    n_frames = xyz.shape[0]
+
+    if spacing is not None:
+        n_origs = int(n_frames / spacing)
+    origins = np.linspace(0, n_frames, n_origs, dtype=int, endpoint=False)
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    if n_blocks is None:
+        n_blocks = 4*max_workers
+    blocks = [block for block in np.array_split(origins, n_blocks) if block.size > 0]
+
+    xyz = np.asarray(xyz)
+    shm = shared_memory.SharedMemory(create=True, size=max(xyz.nbytes, 1))
+    try:
+        shared_xyz = np.ndarray(xyz.shape, dtype=xyz.dtype, buffer=shm.buf)
+        shared_xyz[:] = xyz
+        del shared_xyz
+
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=pool_context()) as executor:
+            partials = executor.map(_msd_shared_block, itertools.repeat(shm.name),
+                                    itertools.repeat(xyz.shape), itertools.repeat(xyz.dtype),
+                                    blocks, itertools.repeat(n_points))
+
+            correlation = np.zeros((n_points, xyz.shape[1]), dtype=np.float64)
+            n_contribs = np.zeros((n_points,), dtype=np.float64)
+            for i, (block_correlation, block_contribs) in enumerate(partials):
+                print('\r{: 3d}% calculated'.format(round((i+1)*100/len(blocks))),
+                      end='', flush=True)
+                correlation += block_correlation
+                n_contribs += block_contribs
+    finally:
+        shm.close()
+        shm.unlink()
+
+    result = correlation/n_contribs[:, np.newaxis]
     x_axis = np.linspace(0, (n_points-1)*dt, n_points)
 
     if average:
@@ -165,7 +531,222 @@ def msd_raw(xyz, dt, n_origs, spacing=None, average=True, upper=None):
     return x_axis, result
 
 
-def get_coms_traj(traj, mol_elements=['H', 'O'], mol_order=['O', 'H', 'H']):
+def msd_moments(xyz, dt, n_origs, spacing=None, upper=None, per_atom=False,
+                dtype=np.float64):
+    """
+    Calculate MSD together with the 4th moment of displacements in a single
+    pass over the origins. Only one count per lag is kept for all atoms and
+    per-atom values are accumulated only if requested
+
+    :param numpy.Array xyz: 3 dimensional array containing positions of objects
+    for which msd is to be calculated
+    :param int dt: Timestep for the given trajectory
+    :param int n_origs: Number of origins to use for the correlation function
+    :param int spacing: Spacing between origins, overrides `n_origs`
+    :param float upper: Upper window for the msd
+    :param bool per_atom: If the msd of every atom should be kept
+    :param dtype: Data type of the per-atom msd, float32 halves its memory
+    :return: x axis array and dictionary with 'msd', non-Gaussian parameter
+    'alpha2' and variance of squared displacements 'r2_variance'. With
+    `per_atom`, it also contains per-atom msd 'msd_atoms' and the variance
+    of the msd across atoms 'atom_variance'
+    :rtype: tuple -> `numpy.Array` and dict
+    """
+    if upper is None:
+        upper = xyz.shape[0]*dt
+
+    n_points = int(upper/dt)
+    n_frames = xyz.shape[0]
+    n_atoms = xyz.shape[1]
+
+    if spacing is not None:
+        n_origs = int(n_frames / spacing)
+    origins = np.linspace(0, n_frames, n_origs, dtype=int, endpoint=False)
+
+    n_contribs = np.zeros((n_points,), dtype=np.float64)
+    r2_sum = np.zeros((n_points,), dtype=np.float64)
+    r4_sum = np.zeros((n_points,), dtype=np.float64)
+    if per_atom:
+        atom_r2 = np.zeros((n_points, n_atoms), dtype=dtype)
+
+    print_threshold = max(1, round(n_origs / 100))
+
+    for i, origin in enumerate(origins):
+        if i % print_threshold == 0:
+            print('\r{: 3d}% calculated'.format(round(i*100/n_origs)),
+                  end='', flush=True)
+
+        upper_pt = origin+n_points
+
+        ref = xyz[origin, :, :]
+        r2 = ((xyz[origin:upper_pt, :, :] - ref)**2).sum(axis=2)
+        n_lags = r2.shape[0]
+
+        n_contribs[:n_lags] += 1
+        r2_sum[:n_lags] += r2.sum(axis=1)
+        r4_sum[:n_lags] += (r2**2).sum(axis=1)
+        if per_atom:
+            atom_r2[:n_lags] += r2
+
+    msd = r2_sum/(n_contribs*n_atoms)
+    r4 = r4_sum/(n_contribs*n_atoms)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        alpha2 = 3.0*r4/(5.0*msd**2) - 1.0
+
+    stats = {'msd': msd, 'alpha2': alpha2, 'r2_variance': r4 - msd**2}
+
+    if per_atom:
+        atom_r2 /= n_contribs[:, np.newaxis].astype(dtype)
+        stats['msd_atoms'] = atom_r2
+        stats['atom_variance'] = np.var(atom_r2, axis=1, dtype=np.float64)
+
+    x_axis = np.linspace(0, (n_points-1)*dt, n_points)
+
+    return x_axis, stats
+
+
+def msd_stream(chunks, dt, upper, spacing=1, average=True):
+    """
+    Calculate MSD from an iterable of trajectory chunks without holding the
+    whole trajectory in memory. Only the origins that are within the `upper`
+    window of the current frame are kept in a ring buffer, so the peak memory
+    depends on `upper` and `spacing`, not on the length of the trajectory
+
+    :param chunks: Iterable of 3 dimensional arrays of shape
+    (n_frames, n_atoms, 3), for instance `xyz` of chunks from `mdtraj.iterload`
+    :param int dt: Timestep for the given trajectory
+    :param float upper: Upper window for the msd
+    :param int spacing: Spacing between origins in frames
+    :param bool average: If the msd should be averaged over all atoms
+    :return: x axis array and msd array
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    n_points = int(upper/dt)
+    n_slots = -(-n_points // spacing)
+
+    origins = None
+    origin_frames = np.full((n_slots,), -1, dtype=np.int64)
+    n_contribs = np.zeros((n_points,), dtype=np.float64)
+    correlation = None
+
+    i_frame = 0
+    for chunk in chunks:
+        if origins is None:
+            n_atoms = chunk.shape[1]
+            origins = np.zeros((n_slots, n_atoms, 3), dtype=np.float64)
+            correlation = np.zeros((n_points, n_atoms), dtype=np.float64)
+
+        for frame in chunk:
+            if i_frame % spacing == 0:
+                slot = (i_frame // spacing) % n_slots
+                origins[slot] = frame
+                origin_frames[slot] = i_frame
+
+            lags = i_frame - origin_frames
+            valid = (origin_frames >= 0) & (lags < n_points)
+            lags = lags[valid]
+
+            correlation[lags] += ((frame - origins[valid])**2).sum(axis=2)
+            n_contribs[lags] += 1
+            i_frame += 1
+
+        print('\rframe = {:d}'.format(i_frame), end='', flush=True)
+
+    print()
+
+    if correlation is None:
+        raise ValueError("No frames were passed to calculate msd")
+
+    result = correlation/n_contribs[:, np.newaxis]
+    x_axis = np.linspace(0, (n_points-1)*dt, n_points)
+
+    if average:
+        return x_axis, np.mean(result, axis=1)
+
+    return x_axis, result
+
+
+def msd_iterload(trajectory, top, upper, dt=None, spacing=1, chunks=100,
+                 atoms='all', stride=None, average=True, unwrap=False):
+    """
+    Calculate MSD for a trajectory that does not fit into memory. The
+    trajectory is read with `mdtraj.iterload` and passed to `msd_stream`
+
+    :param str trajectory: Filename of trajectory - for instance .xtc format
+    :param str top: Filename of topology - for instance .gro format
+    :param float upper: Upper window for the msd
+    :param float dt: Timestep for the given trajectory. If not specified,
+    the timestep of the first chunk is used
+    :param int spacing: Spacing between origins in frames
+    :param int chunks: Number of frames loaded at once
+    :param str atoms: Description of atoms using atom selection language,
+    usually element name
+    :param int stride: Read only every stride-th frame
+    :param bool average: If the msd should be averaged over all atoms
+    :param bool unwrap: If the positions should be unwrapped with `unwrap_stream`
+    before calculating msd
+    :return: x axis array and msd array
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    topology = md.load_topology(top)
+
+    if atoms != 'all':
+        atoms = 'name ' + atoms
+
+    indicies = topology.select(atoms)
+
+    if indicies.size == 0:
+        raise ValueError('No atoms with {:s}'.format(atoms))
+
+    traj = md.iterload(trajectory, top=topology, chunk=chunks, stride=stride,
+                       atom_indices=indicies)
+
+    if dt is None:
+        first = next(traj)
+        dt = first.timestep
+        traj = itertools.chain([first], traj)
+
+    if unwrap:
+        xyz_chunks = unwrap_stream(traj)
+    else:
+        xyz_chunks = (chunk.xyz for chunk in traj)
+
+    return msd_stream(xyz_chunks, dt, upper, spacing=spacing, average=average)
+
+
+def msd_multitau(xyz, dt, average=True, block_length=16, averaging=2):
+    """
+    Calculate MSD at logarithmically spaced lags using the multi-tau
+    correlator. Memory needed by the correlator grows only with the
+    logarithm of the trajectory length
+
+    :param xyz: 3 dimensional array containing positions of objects
+    for which msd is to be calculated, or any iterable of frames
+    :param int dt: Timestep for the given trajectory
+    :param bool average: If the msd should be averaged over all atoms
+    :param int block_length: Number of lags evaluated per level of the correlator
+    :param int averaging: Coarse-graining factor between the levels
+    :return: non-uniform x axis array and msd array
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    correlator = None
+    for frame in xyz:
+        if correlator is None:
+            correlator = MultiTauCorrelator(frame.shape, kind='msd', block_length=block_length,
+                                            averaging=averaging)
+        correlator.add(frame)
+
+    lags, result = correlator.result()
+    x_axis = lags*dt
+
+    if average:
+        return x_axis, np.mean(result, axis=1)
+
+    return x_axis, result
+
+
+def get_coms_traj(traj, mol_elements=['H', 'O'], mol_order=['O', 'H', 'H'], chunk=1000):
     masses = {}
     for atom in traj.top.atoms:
         sym = atom.element.symbol
@@ -174,24 +755,24 @@ def get_coms_traj(traj, mol_elements=['H', 'O'], mol_order=['O', 'H', 'H']):
         if len(masses) == len(mol_elements):
             break
 
-    mols = np.arange(traj.n_atoms).reshape(int(traj.n_atoms/3), 3)
     weights = [masses[element] for element in mol_order]
 
-    return np.average(traj.xyz[:, mols], axis=2, weights=weights)
-
+    return get_coms(traj.xyz, weights, chunk=chunk)
 
-def get_coms(vectors, masses):
-    """TODO: Homogeneous system
-
-    Parameters
-    ----------
-    vectors : TODO
-    masses : TODO
-
-    Returns
-    -------
-    TODO
 
+def get_coms(vectors, masses, chunk=1000, out=None):
+    """
+    Calculate center of masses trajectory for a homogeneous system, where
+    every molecule consists of `len(masses)` consecutive atoms
+
+    :param numpy.Array vectors: 3 dimensional array of positions with
+    shape (n_frames, n_atoms, 3)
+    :param list masses: Masses of the atoms of a single molecule
+    :param int chunk: Number of frames processed at once
+    :param numpy.Array out: Array of shape (n_frames, n_mols, 3) to write
+    the center of masses into, for instance a memmap
+    :return: center of masses trajectory of shape (n_frames, n_mols, 3)
+    :rtype: `numpy.Array`
     """
     if vectors.shape[1] % len(masses) != 0:
         raise ValueError("The {:d} of atoms is not divisible by {:d} masses".format(vectors.shape[1], len(masses)))
@@ -199,10 +780,101 @@ def get_coms(vectors, masses):
     n_mols = int(vectors.shape[1]/len(masses))
     mol_size = len(masses)
 
-    # TODO explain
-    indeces_mols = np.arange(vectors.shape[1]).reshape(n_mols, mol_size)
+    atom_masses = np.tile(np.asarray(masses, dtype=np.float64), n_mols)
+    starts = np.arange(0, vectors.shape[1], mol_size)
+
+    return _segment_coms(vectors, None, starts, atom_masses, chunk, out)
+
+
+def get_coms_mols(vectors, topology, groups='residues', chunk=1000, out=None):
+    """
+    Calculate center of masses trajectory for molecules of arbitrary sizes
+    and mixtures of molecules given by the topology. The positions are
+    processed in chunks of frames, so no copy of the whole trajectory is made
+
+    :param numpy.Array vectors: 3 dimensional array of positions with
+    shape (n_frames, n_atoms, 3)
+    :param `mdtraj.Topology` topology: Topology with the atoms of `vectors`
+    :param groups: Either 'residues', 'molecules' (molecules found from
+    bonds) or a list of arrays of atom indices of every molecule
+    :param int chunk: Number of frames processed at once
+    :param numpy.Array out: Array of shape (n_frames, n_mols, 3) to write
+    the center of masses into, for instance a memmap
+    :return: center of masses trajectory of shape (n_frames, n_mols, 3)
+    :rtype: `numpy.Array`
+    """
+    if groups == 'residues':
+        groups = [[atom.index for atom in residue.atoms] for residue in topology.residues]
+    elif groups == 'molecules':
+        groups = [sorted(atom.index for atom in molecule) for molecule in topology.find_molecules()]
+
+    groups = [np.asarray(group, dtype=int) for group in groups]
+    if any(group.size == 0 for group in groups):
+        raise ValueError("Every molecule has to contain at least one atom")
+
+    order = np.concatenate(groups)
+    starts = np.cumsum([0] + [group.size for group in groups[:-1]])
+
+    atom_masses = np.array([atom.element.mass for atom in topology.atoms], dtype=np.float64)[order]
+
+    # Gathering is needed only if the molecules are not stored contiguously
+    if order.size == vectors.shape[1] and (order == np.arange(order.size)).all():
+        order = None
+
+    return _segment_coms(vectors, order, starts, atom_masses, chunk, out)
+
+
+def get_bond_vectors(vectors, first, second, normalize=True, chunk=1000):
+    """
+    Calculate vectors from atoms `first` to atoms `second` for every frame,
+    for instance OH bond vectors of water for rotational correlations
+
+    :param numpy.Array vectors: 3 dimensional array of positions with
+    shape (n_frames, n_atoms, 3)
+    :param first: Indices of the atoms where the vectors start
+    :param second: Indices of the atoms where the vectors end
+    :param bool normalize: If the vectors should have unit length
+    :param int chunk: Number of frames processed at once
+    :return: vectors of shape (n_frames, n_vectors, 3)
+    :rtype: `numpy.Array`
+    """
+    first = np.asarray(first, dtype=int)
+    second = np.asarray(second, dtype=int)
+    if first.shape != second.shape:
+        raise ValueError("The {:d} start atoms do not match {:d} end atoms".format(first.size, second.size))
+
+    bonds = np.empty((vectors.shape[0], first.size, 3), dtype=vectors.dtype)
+    for begin in range(0, vectors.shape[0], chunk):
+        block = vectors[begin:begin+chunk]
+        np.subtract(block[:, second], block[:, first], out=bonds[begin:begin+chunk])
+
+    if normalize:
+        bonds /= np.linalg.norm(bonds, axis=2, keepdims=True)
+
+    return bonds
+
+
+def _segment_coms(vectors, order, starts, atom_masses, chunk, out):
+    """
+    Mass weighted average of consecutive segments of atoms starting
+    at `starts` using `np.add.reduceat`. If `order` is given, the atoms
+    of every chunk are gathered in that order first
+    """
+    n_frames = vectors.shape[0]
+    mol_masses = np.add.reduceat(atom_masses, starts)
+
+    if out is None:
+        out = np.empty((n_frames, starts.size, 3), dtype=np.result_type(vectors.dtype, np.float64))
+
+    weights = atom_masses[:, np.newaxis]
+    for begin in range(0, n_frames, chunk):
+        block = vectors[begin:begin+chunk]
+        if order is not None:
+            block = block[:, order]
+        summed = np.add.reduceat(block*weights, starts, axis=1)
+        out[begin:begin+chunk] = summed / mol_masses[:, np.newaxis]
 
-    return np.average(vectors[:, indeces_mols], axis=2, weights=masses)
+    return out
 
 
 def _msd_raw_depreceated(xyz, dt, n_origs, average=True):
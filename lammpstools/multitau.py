@@ -0,0 +1,116 @@
+"""
+Multi-tau correlator evaluating correlation functions at logarithmically
+spaced lags
+"""
+
+import numpy as np
+
+
+class _Level:
+    def __init__(self, block_length, shape):
+        self.buffer = np.zeros((block_length,) + shape, dtype=np.float64)
+        self.correlation = np.zeros((block_length,) + shape[:-1], dtype=np.float64)
+        self.n_contribs = np.zeros((block_length,), dtype=np.float64)
+        self.accumulator = np.zeros(shape, dtype=np.float64)
+        self.n_accumulated = 0
+        self.n_inserted = 0
+
+
+class MultiTauCorrelator:
+    """
+    Hierarchical (multi-tau) correlator. Level 0 holds the last
+    `block_length` samples and evaluates lags 0, 1, ..., block_length-1.
+    Every `averaging` samples of a level are coarse-grained into one sample
+    of the next level, which evaluates lags block_length/averaging, ...,
+    block_length-1 in units of its own coarse-grained timestep. Levels are
+    created only when the data reaches them, hence the memory grows with
+    the logarithm of the number of samples.
+
+    For `kind='acf'` the correlation is sum(a(t)*a(t+tau)) over the last
+    axis of a sample and samples are coarse-grained by averaging. For
+    `kind='msd'` it is sum((a(t+tau)-a(t))**2) and the coarse-grained sample
+    is the first sample of the block, so that the lags stay exact
+
+    :param tuple shape: Shape of a single sample, for instance (n_atoms, 3)
+    :param str kind: Either 'acf' or 'msd'
+    :param int block_length: Number of lags evaluated per level
+    :param int averaging: Coarse-graining factor between two levels
+    """
+
+    def __init__(self, shape, kind='acf', block_length=16, averaging=2):
+        if kind not in ['acf', 'msd']:
+            raise ValueError("Unknown kind {:s} of correlation".format(kind))
+        if block_length % averaging != 0:
+            raise ValueError("Block length {:d} is not divisible by averaging {:d}".format(
+                block_length, averaging))
+
+        self.shape = tuple(shape)
+        self.kind = kind
+        self.block_length = block_length
+        self.averaging = averaging
+        self.levels = []
+
+    def add(self, sample):
+        """Add a single sample of shape `shape` to the correlator"""
+        self._insert(0, np.asarray(sample, dtype=np.float64))
+
+    def add_chunk(self, chunk):
+        """Add all samples of a chunk with shape (n_samples, *shape)"""
+        for sample in chunk:
+            self.add(sample)
+
+    def _insert(self, i_level, sample):
+        if i_level == len(self.levels):
+            self.levels.append(_Level(self.block_length, self.shape))
+
+        level = self.levels[i_level]
+        position = level.n_inserted % self.block_length
+        level.buffer[position] = sample
+        level.n_inserted += 1
+
+        first_lag = 0 if i_level == 0 else self.block_length // self.averaging
+        n_valid = min(level.n_inserted, self.block_length)
+        if n_valid > first_lag:
+            past = level.buffer[(position - np.arange(first_lag, n_valid)) % self.block_length]
+            if self.kind == 'acf':
+                contr = (past * sample).sum(axis=-1)
+            else:
+                contr = ((past - sample)**2).sum(axis=-1)
+            level.correlation[first_lag:n_valid] += contr
+            level.n_contribs[first_lag:n_valid] += 1
+
+        if self.kind == 'acf':
+            level.accumulator += sample
+        elif level.n_accumulated == 0:
+            level.accumulator[:] = sample
+        level.n_accumulated += 1
+
+        if level.n_accumulated == self.averaging:
+            coarse = level.accumulator.copy()
+            if self.kind == 'acf':
+                coarse /= self.averaging
+            level.accumulator[:] = 0.0
+            level.n_accumulated = 0
+            self._insert(i_level+1, coarse)
+
+    def result(self):
+        """
+        Return the lags in units of the original timestep and the correlation
+        at those lags
+
+        :return: lags and correlation of shape (n_lags, *shape[:-1])
+        :rtype: tuple -> `numpy.Array` and `numpy.Array`
+        """
+        lags = []
+        values = []
+        for i_level, level in enumerate(self.levels):
+            first_lag = 0 if i_level == 0 else self.block_length // self.averaging
+            filled = np.nonzero(level.n_contribs[first_lag:])[0] + first_lag
+            lags.append(filled * self.averaging**i_level)
+            values.append(level.correlation[filled] / level.n_contribs[filled].reshape(
+                (-1,) + (1,)*(len(self.shape)-1)))
+
+        if not lags:
+            raise ValueError("No samples were added to the correlator")
+
+        return np.concatenate(lags), np.concatenate(values)
@@ -0,0 +1,16 @@
+"""
+Helpers shared by the process-parallel routines of lammpstools
+"""
+
+import multiprocessing
+
+
+def pool_context():
+    """
+    Multiprocessing context for the process pools. Forked workers would inherit
+    threads of the numba engine, hence forkserver is used where available
+    """
+    try:
+        return multiprocessing.get_context('forkserver')
+    except ValueError:
+        return None
@@ -1,5 +1,14 @@
+import itertools
 import time as tm
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from scipy import fft
+from mdanalysis.timeseries import integrate_series, find_plateau
+
+from .mdt import msd_raw
+from .multitau import MultiTauCorrelator
+from .parallel import pool_context
 
 
 def stress_acf_old(tensors, dt, n_origs, upper=None):
@@ -40,13 +49,14 @@ def stress_acf_old(tensors, dt, n_origs, upper=None):
 
 
 def stress_acf(tensors, dt, spacing, upper=None,
-               normalized=True, avg=True, extended=False):
+               normalized=True, avg=True, extended=False, method='direct'):
     """
-    Calculate stress autocorrelation function for given 3d array of
+    Calculate stress autocorrelation function for given 2d array of
     off-diagonal stress tensors
 
-    :param `numpy.Array` tensors: 3d array of off-diagonal
-    stress tensor entries
+    :param `numpy.Array` tensors: 2d array of off-diagonal
+    stress tensor entries with shape (n_components, n_frames), see
+    `stress_batch`
     :param int dt: Timestep between two data points
     :param int spacing: Spacing between origins
     :param float upper: Upper window for the autocorrelation function. If
@@ -55,7 +65,12 @@ def stress_acf(tensors, dt, spacing, upper=None,
     :param bool normalized: If the acf should be normalized - normalizing is
     done by dividing by variance of the data
     :param bool avg: If the autocorrelation function
-    should be averaged over the three entries
+    should be averaged over the entries
+    :param bool extended: If the summed correlation and number of
+    contributions should be returned together with the acf
+    :param str method: Either 'direct', which loops over the origins, or
+    'fft', which uses every frame as an origin and correlates all components
+    at once in O(N log N) time. `spacing` is ignored by the 'fft' method
     :return: x axis array and stress autocorrelation array
     :rtype: tuple -> `numpy.Array` and `numpy.Array`
     """
@@ -65,17 +80,59 @@ def stress_acf(tensors, dt, spacing, upper=None,
     n_frames = tensors.shape[1]
     n_points = int(upper/dt)
 
-    n_contribs = np.zeros((3, n_points), dtype=np.float64)
-    correlation = np.zeros((3, n_points), dtype=np.float64)
-
-    n_origs = int(n_frames / spacing)
-    origins = np.linspace(0, n_frames, n_origs, dtype=int, endpoint=False)
-#     mean = np.mean(tensors, axis=1, keepdims=True)
     if normalized:
         var = np.var(tensors, axis=1, keepdims=True)
     else:
         var = 1.0
 
+    if method == 'fft':
+        correlation, n_contribs = _acf_fft_sums(tensors, n_points)
+        correlation /= var
+    elif method == 'direct':
+        correlation, n_contribs = _acf_direct_sums(tensors, dt, spacing, n_points, var)
+    else:
+        raise ValueError("Unknown method {:s} for stress acf".format(method))
+
+    result = correlation/n_contribs
+
+    if avg:
+        return np.mean(result, axis=0)
+
+    if extended:
+        return correlation, n_contribs, result
+
+    return result
+
+
+def stress_batch(pxy, pxz, pyz, pxx=None, pyy=None, pzz=None):
+    """
+    Stack stress tensor components into a 2d array for `stress_acf`.
+    If the diagonal components are given, (Pxx-Pyy)/2 and (Pyy-Pzz)/2 are
+    added to the three off-diagonal components, which in an isotropic
+    fluid have the same autocorrelation function
+
+    :return: array of shape (3, n_frames) or (5, n_frames)
+    :rtype: `numpy.Array`
+    """
+    components = [pxy, pxz, pyz]
+    if pxx is not None and pyy is not None and pzz is not None:
+        components += [0.5*(pxx - pyy), 0.5*(pyy - pzz)]
+    elif any(diagonal is not None for diagonal in [pxx, pyy, pzz]):
+        raise ValueError("Either all or none of the diagonal components have to be given")
+
+    return np.array(components, dtype=np.float64)
+
+
+def _acf_direct_sums(tensors, dt, spacing, n_points, var):
+    n_frames = tensors.shape[1]
+    n_components = tensors.shape[0]
+
+    n_contribs = np.zeros((n_components, n_points), dtype=np.float64)
+    correlation = np.zeros((n_components, n_points), dtype=np.float64)
+
+    n_origs = int(n_frames / spacing)
+    origins = np.linspace(0, n_frames, n_origs, dtype=int, endpoint=False)
+
     time_0 = tm.time()
     for origin in origins:
         upper_pt = origin+n_points
@@ -93,12 +150,401 @@ def stress_acf(tensors, dt, spacing, upper=None,
         correlation[:viscosity_contr.shape[0],
                     :viscosity_contr.shape[1]] += viscosity_contr
 
-    result = correlation/n_contribs
+    return correlation, n_contribs
+
+
+def _acf_fft_sums(tensors, n_points):
+    """
+    Sums of products over all origins for lags up to `n_points` using
+    zero padded FFT along the last axis. Lags longer than the series get
+    no contributions
+    """
+    n_frames = tensors.shape[-1]
+    n_lags = min(n_points, n_frames)
+    n_fft = fft.next_fast_len(n_frames + n_lags)
+
+    transformed = fft.rfft(tensors, n=n_fft, axis=-1)
+    power = transformed.real**2 + transformed.imag**2
+
+    correlation = np.zeros(tensors.shape[:-1] + (n_points,), dtype=np.float64)
+    correlation[..., :n_lags] = fft.irfft(power, n=n_fft, axis=-1)[..., :n_lags]
+
+    n_contribs = np.zeros(tensors.shape[:-1] + (n_points,), dtype=np.float64)
+    n_contribs[..., :n_lags] = n_frames - np.arange(n_lags)
+
+    return correlation, n_contribs
+
+
+def stress_acf_multitau(tensors, dt, normalized=True, avg=True,
+                        block_length=16, averaging=2):
+    """
+    Calculate stress autocorrelation function at logarithmically spaced lags
+    using the multi-tau correlator
+
+    :param `numpy.Array` tensors: 2d array of off-diagonal
+    stress tensor entries with shape (n_components, n_frames)
+    :param int dt: Timestep between two data points
+    :param bool normalized: If the acf should be normalized - normalizing is
+    done by dividing by variance of the data
+    :param bool avg: If the autocorrelation function
+    should be averaged over the entries
+    :param int block_length: Number of lags evaluated per level of the correlator
+    :param int averaging: Coarse-graining factor between the levels
+    :return: non-uniform x axis array and stress autocorrelation array
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    correlator = MultiTauCorrelator((tensors.shape[0], 1), kind='acf',
+                                    block_length=block_length, averaging=averaging)
+    correlator.add_chunk(tensors.T[:, :, np.newaxis])
+
+    lags, result = correlator.result()
+    result = result.T
+    if normalized:
+        result = result / np.var(tensors, axis=1, keepdims=True)
+
+    x_axis = lags*dt
 
     if avg:
-        return np.mean(result, axis=0)
+        return x_axis, np.mean(result, axis=0)
 
-    if extended:
-        return correlation, n_contribs, result
+    return x_axis, result
 
-    return result
+
+def viscosity_bootstrap(tensors, dt, block_size, upper=None, prefactor=1.0, block_stride=None,
+                        n_boot=1000, confidence=0.95, max_workers=None, seed=None):
+    """
+    Estimate uncertainty of the Green-Kubo viscosity with block averaging
+    and (moving) block bootstrap. The acf sums of every block are calculated
+    once with FFT in a process pool. Every bootstrap resample is then only a
+    weighted sum of the block sums, no acf is recalculated
+
+    :param `numpy.Array` tensors: 2d array of stress tensor entries with
+    shape (n_components, n_frames), see `stress_batch`
+    :param int dt: Timestep between two data points
+    :param int block_size: Number of frames in a block
+    :param float upper: Upper window for the autocorrelation function, by
+    default the block length
+    :param float prefactor: Factor converting the integral of the acf to viscosity
+    :param int block_stride: Frames between starts of two blocks. By default
+    equal to `block_size` (non-overlapping blocks), smaller values give
+    overlapping blocks of the moving block bootstrap
+    :param int n_boot: Number of bootstrap resamples
+    :param float confidence: Confidence level of the bands
+    :param int max_workers: Number of worker processes, 1 runs serially
+    :param int seed: Seed for the resampling
+    :return: dictionary with time axis 'time', acf 'acf' and running integral
+    'integral' of the whole series, bootstrap standard error 'stderr' and
+    confidence bands 'lower' and 'upper' of the integral, integrals of every
+    block 'block_integrals' with their standard error 'block_stderr' and
+    'viscosity', 'viscosity_stderr' at the upper window
+    :rtype: dict
+    """
+    n_frames = tensors.shape[1]
+    if upper is None:
+        upper = block_size*dt
+    n_points = int(upper/dt)
+    if block_stride is None:
+        block_stride = block_size
+
+    starts = range(0, n_frames-block_size+1, block_stride)
+    blocks = [tensors[:, start:start+block_size] for start in starts]
+    if len(blocks) < 2:
+        raise ValueError("At least two blocks are needed, got {:d}".format(len(blocks)))
+
+    if max_workers == 1:
+        sums = [_block_acf_sums(block, n_points) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=pool_context()) as executor:
+            sums = list(executor.map(_block_acf_sums, blocks, itertools.repeat(n_points)))
+
+    block_correlation = np.array([correlation for correlation, _ in sums])
+    block_contribs = np.array([n_contribs for _, n_contribs in sums])
+
+    block_integrals = prefactor*integrate_series(block_correlation/block_contribs, dt=dt)
+    n_independent = n_frames // block_size
+    block_stderr = np.std(block_integrals, axis=0, ddof=1) / np.sqrt(n_independent)
+
+    # Resampling weights: how many times each block is drawn
+    rng = np.random.default_rng(seed)
+    draws = rng.integers(0, len(blocks), size=(n_boot, n_independent))
+    weights = np.zeros((n_boot, len(blocks)), dtype=np.float64)
+    np.add.at(weights, (np.arange(n_boot)[:, np.newaxis], draws), 1.0)
+
+    boot_integrals = prefactor*integrate_series((weights @ block_correlation)/(weights @ block_contribs), dt=dt)
+    tail = 0.5*(1.0 - confidence)
+    lower, upper_band = np.quantile(boot_integrals, [tail, 1.0 - tail], axis=0)
+
+    acf = block_correlation.sum(axis=0)/block_contribs.sum(axis=0)
+    integral = prefactor*integrate_series(acf, dt=dt)
+    stderr = np.std(boot_integrals, axis=0, ddof=1)
+
+    return {'time': np.linspace(0, (n_points-1)*dt, n_points), 'acf': acf,
+            'integral': integral, 'stderr': stderr, 'lower': lower, 'upper': upper_band,
+            'block_integrals': block_integrals, 'block_stderr': block_stderr,
+            'viscosity': integral[-1], 'viscosity_stderr': stderr[-1]}
+
+
+def einstein_helfand(tensors, dt, spacing=None, upper=None, avg=True, method='fft'):
+    """
+    Calculate mean squared displacement of the Helfand moments, the time
+    integrals of the stress tensor components. The cumulative integrals are
+    built once and their msd is evaluated with `mdt.msd_raw`, by default with
+    its FFT method. Viscosity follows from the slope, see `helfand_viscosity`
+
+    :param `numpy.Array` tensors: 2d array of stress tensor entries with
+    shape (n_components, n_frames), see `stress_batch`
+    :param int dt: Timestep between two data points
+    :param int spacing: Spacing between origins, used only by the 'direct'
+    method, every frame is an origin by default
+    :param float upper: Upper window for the msd
+    :param bool avg: If the msd should be averaged over the entries
+    :param str method: Method of `mdt.msd_raw`, either 'fft' or 'direct'
+    :return: x axis array and msd of the Helfand moments
+    :rtype: tuple -> `numpy.Array` and `numpy.Array`
+    """
+    if method == 'direct':
+        if spacing is None:
+            spacing = 1
+        elif spacing < 1:
+            raise ValueError("Spacing between origins has to be positive, got {}".format(spacing))
+
+    helfand = np.cumsum(tensors, axis=1)*dt
+
+    x_axis, result = msd_raw(helfand.T[:, :, np.newaxis], dt, None, spacing=spacing,
+                             average=avg, upper=upper, method=method)
+
+    if avg:
+        return x_axis, result
+
+    return x_axis, result.T
+
+
+def helfand_viscosity(x_axis, helfand_msd, lower, upper, prefactor=1.0):
+    """
+    Viscosity from the linear regime of the Helfand moments msd,
+    eta = prefactor * slope / 2
+
+    :param `numpy.Array` x_axis: Time axis returned by `einstein_helfand`
+    :param `numpy.Array` helfand_msd: Averaged msd returned by `einstein_helfand`
+    :param float lower: Start of the linear regime
+    :param float upper: End of the linear regime
+    :param float prefactor: Usually V/(kB T) together with unit conversion
+    :return: viscosity estimate
+    :rtype: float
+    """
+    fit_range = (x_axis >= lower) & (x_axis <= upper)
+    if np.count_nonzero(fit_range) < 2:
+        raise ValueError("At least two points are needed between {} and {}".format(lower, upper))
+
+    slope = np.polyfit(x_axis[fit_range], helfand_msd[fit_range], 1)[0]
+    return prefactor*slope/2.0
+
+
+def _block_acf_sums(block, n_points):
+    """ACF sums of a single block summed over its components"""
+    correlation, n_contribs = _acf_fft_sums(block, n_points)
+    return correlation.sum(axis=0), n_contribs.sum(axis=0)
+
+
+class GreenKuboStream:
+    """
+    Online Green-Kubo estimator of viscosity. Rows of stress tensor
+    components are added with `update` (or read incrementally from a
+    LAMMPS `fix ave/time` file with `feed_file`) and the autocorrelation
+    function is accumulated in blocks of rows with one FFT per block.
+    Only the last `upper/dt` rows and the accumulated sums are kept, so
+    the memory does not grow with the length of the run
+
+    :param int n_components: Number of stress components in every row
+    :param float dt: Timestep between two rows
+    :param float upper: Upper window for the autocorrelation function
+    :param float prefactor: Factor converting the integral of the acf to
+    viscosity, usually V/(kB T) together with unit conversion
+    :param int block: Number of rows processed at once, by default the
+    number of lags of the acf
+    """
+
+    def __init__(self, n_components, dt, upper, prefactor=1.0, block=None):
+        self.n_components = n_components
+        self.dt = dt
+        self.n_points = int(upper/dt)
+        self.prefactor = prefactor
+        self.block = self.n_points if block is None else block
+
+        self.correlation = np.zeros((n_components, self.n_points), dtype=np.float64)
+        self.n_contribs = np.zeros((self.n_points,), dtype=np.float64)
+        self.n_samples = 0
+
+        self._history = np.zeros((n_components, 0), dtype=np.float64)
+        self._pending = []
+        self._n_pending = 0
+        self._files = {}
+
+    def update(self, rows):
+        """Add rows of shape (n_rows, n_components) or a single row"""
+        rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+        if rows.shape[1] != self.n_components:
+            raise ValueError("Expected {:d} components, got {:d}".format(self.n_components, rows.shape[1]))
+
+        self._pending.append(rows)
+        self._n_pending += rows.shape[0]
+        if self._n_pending >= self.block:
+            self.flush()
+
+    def flush(self):
+        """Correlate all pending rows"""
+        if self._n_pending == 0:
+            return
+
+        new = np.concatenate(self._pending).T
+        self._pending = []
+        self._n_pending = 0
+
+        n_history = self._history.shape[1]
+        n_new = new.shape[1]
+        combined = np.concatenate([self._history, new], axis=1)
+
+        # Products of every new row with all rows at most n_points-1 before it
+        n_lags = min(self.n_points, combined.shape[1])
+        n_fft = fft.next_fast_len(combined.shape[1] + n_lags)
+        shifted = np.zeros_like(combined)
+        shifted[:, n_history:] = new
+        cross = fft.rfft(shifted, n=n_fft, axis=1) * np.conj(fft.rfft(combined, n=n_fft, axis=1))
+        self.correlation[:, :n_lags] += fft.irfft(cross, n=n_fft, axis=1)[:, :n_lags]
+
+        lags = np.arange(self.n_points)
+        self.n_contribs += n_new - np.clip(lags - self.n_samples, 0, n_new)
+
+        self.n_samples += n_new
+        self._history = combined[:, max(0, combined.shape[1]-self.n_points+1):]
+
+    def feed_file(self, filename, columns=None, identifier='TimeStep', chunk=10000):
+        """
+        Read rows from a text file with ordered columns, for instance output of
+        LAMMPS `fix ave/time`. Only the part of the file written since the last
+        call is read, so the file can be fed repeatedly while the run is going
+
+        :param str filename: Name of the file with the stress tensor components
+        :param list columns: Labels or indices of the columns to use, by default
+        all columns after the first one
+        :param str identifier: String identifying the line with column labels
+        :param int chunk: Number of rows passed to `update` at once
+        """
+        position, indices = self._files.get(filename, (None, None))
+
+        with open(filename) as fnm:
+            if position is None:
+                for line in iter(fnm.readline, ''):
+                    if identifier in line:
+                        labels = line.lstrip('#').split()
+                        break
+                else:
+                    raise ValueError("{} not found in the file {}".format(identifier, filename))
+
+                if columns is None:
+                    indices = list(range(1, len(labels)))
+                else:
+                    indices = [labels.index(col) if isinstance(col, str) else col for col in columns]
+                position = fnm.tell()
+            else:
+                fnm.seek(position)
+
+            rows = []
+            while True:
+                line = fnm.readline()
+                # Last line may still be written
+                if not line.endswith('\n'):
+                    break
+                position = fnm.tell()
+
+                values = line.split()
+                if not values or values[0].startswith('#'):
+                    continue
+                try:
+                    rows.append([float(values[i]) for i in indices])
+                except (ValueError, IndexError):
+                    continue
+
+                if len(rows) == chunk:
+                    self.update(rows)
+                    rows = []
+
+            if rows:
+                self.update(rows)
+
+        self._files[filename] = (position, indices)
+
+    @property
+    def acf(self):
+        """Current stress autocorrelation function averaged over the components"""
+        self.flush()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.mean(self.correlation/self.n_contribs, axis=0)
+
+    @property
+    def time_axis(self):
+        return np.linspace(0, (self.n_points-1)*self.dt, self.n_points)
+
+    @property
+    def integral(self):
+        """Running Green-Kubo integral of the current acf"""
+        acf = self.acf
+        n_valid = np.count_nonzero(self.n_contribs)
+        integral = np.full_like(acf, np.nan)
+        integral[:n_valid] = integrate_series(acf[:n_valid], dt=self.dt)
+        return self.prefactor*integral
+
+    def plateau(self, window=None, tol=0.02):
+        """
+        Find the plateau of the running integral with `mdanalysis.find_plateau`.
+        The plateau is the first window whose running average differs from the
+        one of the previous window by less than `tol` relative to it, or the
+        flattest window if there is no such window
+
+        :param int window: Width of the window in number of lags, by default
+        a tenth of the lags
+        :param float tol: Tolerance on the relative change between two windows
+        :return: viscosity estimate and time at the middle of the plateau window
+        :rtype: tuple -> float and float
+        """
+        integral = self.integral
+        integral = integral[~np.isnan(integral)]
+        if window is None:
+            window = max(2, integral.shape[0] // 10)
+        if integral.shape[0] < 2*window:
+            return np.nan, np.nan
+
+        value, time = find_plateau(integral, window, tolerance=tol, dt=self.dt, closest=True)
+        return float(value), float(time)
+
+    @property
+    def viscosity(self):
+        """Current viscosity estimate from the plateau of the running integral"""
+        return self.plateau()[0]
+
+
+def green_kubo_file(filename, dt, upper, columns=None, prefactor=1.0, identifier='TimeStep'):
+    """
+    Estimate viscosity from a stress tensor file without loading it into memory.
+    The returned `GreenKuboStream` can be fed again with `feed_file` as the file grows
+
+    :param str filename: Name of the file with the stress tensor components
+    :param float dt: Timestep between two rows
+    :param float upper: Upper window for the autocorrelation function
+    :param list columns: Labels or indices of the stress tensor columns
+    :param float prefactor: Factor converting the integral of the acf to viscosity
+    :param str identifier: String identifying the line with column labels
+    :return: Green-Kubo estimator
+    :rtype: `GreenKuboStream`
+    """
+    with open(filename) as fnm:
+        for line in fnm:
+            if identifier in line:
+                n_components = len(line.lstrip('#').split()) - 1 if columns is None else len(columns)
+                break
+        else:
+            raise ValueError("{} not found in the file {}".format(identifier, filename))
+
+    estimator = GreenKuboStream(n_components, dt, upper, prefactor=prefactor)
+    estimator.feed_file(filename, columns=columns, identifier=identifier)
+    return estimator
@@ -1,12 +1,36 @@
-"""Utilities for calculation of relatively fast direct correlations"""
+"""Utilities for calculation of relatively fast direct correlations
+
+Numba is imported only when a numba kernel is first needed. Kernels for Legendre polynomials
+are kept in a registry, so every combination of order and data type is compiled only once and
+the compiled code is cached on disk for other processes"""
+import importlib
+
 import numpy as np
-from numba import jit, vectorize, float32, float64
+from scipy import fft, special
+
+from .timeseries import CorrelationFunction
+
 
+__all__ = ["prepare_numba_correlation", "prepare_numba_batch_correlation", "prepare_legendre",
+           "prepare_fft_correlation", "correlate_molecules"]
 
-__all__ = ["prepare_numba_correlation", "prepare_legendre"]
+
+_legendre_ufuncs = {}
+_legendre_orders = {}
+_kernel_registry = {}
 
 
 def prepare_numba_correlation(vectorized_function):
+    order = _legendre_orders.get(id(vectorized_function))
+    if order is not None:
+        return _registered_kernel('correlate_legendre', order)
+
+    key = ('custom', id(vectorized_function))
+    if key in _kernel_registry:
+        return _kernel_registry[key][1]
+
+    from numba import jit
+
     @jit(nopython=True)
     def correlate(data, dt, normalize=False, upper_acf_time=None):
         N = data.shape[0]
@@ -14,7 +38,7 @@ def prepare_numba_correlation(vectorized_function):
         if upper_acf_time is None:
             upper_index = N
         else:
-            upper_index = int(upper_acf_time/dt+1)
+            upper_index = min(int(upper_acf_time/dt+1), N)
 
         corr = np.zeros(upper_index)
 
@@ -28,9 +52,74 @@ def prepare_numba_correlation(vectorized_function):
             corr /= corr[0]
         return corr
 
+    # Keeping the function prevents reuse of its id by another object
+    _kernel_registry[key] = (vectorized_function, correlate)
+    return correlate
+
+
+def prepare_numba_batch_correlation(vectorized_function):
+    """Prepare function calculating correlations of many vector series at once. The function
+    takes data of shape (n_frames, n_molecules, 3) and returns array of shape
+    (n_molecules, n_lags). The molecules are processed in parallel. Only Legendre polynomials
+    from `prepare_legendre` are supported"""
+    order = _legendre_orders.get(id(vectorized_function))
+    if order is None:
+        raise ValueError("Batch correlation is available only for functions from prepare_legendre")
+
+    return _registered_kernel('correlate_legendre_batch', order)
+
+
+def _registered_kernel(name, order):
+    """Return correlate function calling the kernel of the given name from the `kernels`
+    module. The function is created once per kernel and order"""
+    key = (name, order)
+    if key in _kernel_registry:
+        return _kernel_registry[key]
+
+    def correlate(data, dt, normalize=False, upper_acf_time=None):
+        N = data.shape[0]
+
+        if upper_acf_time is None:
+            upper_index = N
+        else:
+            upper_index = min(int(upper_acf_time/dt+1), N)
+
+        kernel = getattr(importlib.import_module('.kernels', __package__), name)
+        corr = kernel(np.ascontiguousarray(data), order, upper_index)
+
+        corr /= np.arange(N, N-upper_index, -1)
+        if normalize:
+            corr /= corr[..., :1]
+        return corr
+
+    _kernel_registry[key] = correlate
     return correlate
 
 
+def correlate_molecules(data, dt, order, label, normalize=False, upper_acf_time=None):
+    """Calculate correlation of Legendre polynomial of the given order for vectors of many
+    molecules, for instance OH bond or dipole vectors, in parallel
+
+    Parameters
+    ----------
+    data : array of vectors with shape (n_frames, n_molecules, 3)
+    dt : time step between the frames
+    order : order of the Legendre polynomial
+    label : label of the returned correlation function
+    normalize : if the correlation of every molecule should be divided by its value at 0, optional
+    upper_acf_time : upper window for the correlation, optional
+
+    Returns
+    -------
+    cf: `CorrelationFunction` with a row for every molecule, whose `average_cf` is the
+        correlation averaged over the molecules
+
+    """
+    correlate_batch = prepare_numba_batch_correlation(prepare_legendre(order))
+    corr = correlate_batch(data, dt, normalize, upper_acf_time)
+    return CorrelationFunction(corr, label, dt=dt)
+
+
 def prepare_legendre(order, numba=True):
     if order == 1:
         def P(x):
@@ -42,7 +131,97 @@ def prepare_legendre(order, numba=True):
         raise NotImplementedError("Order {:d} of Legendre polynomial has not been implemented".format(order))
 
     if numba:
-        vectorizing_factory = vectorize([float32(float32), float64(float64)], nopython=True)
-        return vectorizing_factory(P)
+        if order not in _legendre_ufuncs:
+            from numba import vectorize, float32, float64
+
+            vectorizing_factory = vectorize([float32(float32), float64(float64)], nopython=True, cache=True)
+            ufunc = vectorizing_factory(P)
+            _legendre_ufuncs[order] = ufunc
+            _legendre_orders[id(ufunc)] = order
+        return _legendre_ufuncs[order]
     else:
         return P
+
+
+def prepare_fft_correlation(order):
+    """Prepare function calculating the correlation of Legendre polynomial of the given order,
+    <P_l(u(0).u(t))>, in O(N log N) time with FFT. The returned function has the same signature
+    as the one returned by `prepare_numba_correlation`.
+
+    For orders 1 and 2 the dot product is expanded into Cartesian components, so that the
+    correlation is a weighted sum of 3 or 6 autocorrelations. For higher orders the addition
+    theorem of spherical harmonics is used and the vectors are normalized to unit length
+
+    Parameters
+    ----------
+    order : order of the Legendre polynomial
+
+    Returns
+    -------
+    correlate: function correlate(data, dt, normalize=False, upper_acf_time=None), where
+        data is an array of vectors with shape (n_frames, 3)
+
+    """
+    if order < 1:
+        raise NotImplementedError("Order {:d} of Legendre polynomial has not been implemented".format(order))
+
+    def correlate(data, dt, normalize=False, upper_acf_time=None):
+        N = data.shape[0]
+
+        if upper_acf_time is None:
+            upper_index = N
+        else:
+            upper_index = min(int(upper_acf_time/dt+1), N)
+
+        if order == 1:
+            corr = _autocorrelation_sums(data.T, upper_index).sum(axis=0)
+        elif order == 2:
+            rows, cols = np.triu_indices(3)
+            weights = np.where(rows == cols, 1.0, 2.0)
+            products = data[:, rows] * data[:, cols]
+            squared = weights @ _autocorrelation_sums(products.T, upper_index)
+            corr = 1.5*squared - 0.5*np.arange(N, N-upper_index, -1)
+        else:
+            corr = _spherical_harmonics_sums(data, order, upper_index)
+
+        corr /= np.arange(N, N-upper_index, -1)
+        if normalize:
+            corr /= corr[0]
+        return corr
+
+    return correlate
+
+
+def _spherical_harmonics_sums(data, order, n_lags):
+    """Sums of P_l(u(t).u(t+tau)) over origins from the addition theorem,
+    P_l(u.v) = 4 pi / (2l+1) sum_m Y_lm(u) Y*_lm(v)"""
+    unit = data / np.linalg.norm(data, axis=1, keepdims=True)
+    polar = np.arccos(np.clip(unit[:, 2], -1.0, 1.0))
+    azimuth = np.arctan2(unit[:, 1], unit[:, 0])
+
+    harmonics = np.array([_sph_harm(order, m, polar, azimuth) for m in range(order+1)])
+    sums = _autocorrelation_sums(harmonics, n_lags)
+
+    # Y_l,-m = (-1)^m Y*_lm, so the negative m contribute the same as positive m
+    weights = np.full(order+1, 2.0)
+    weights[0] = 1.0
+    return 4*np.pi/(2*order+1) * (weights @ sums)
+
+
+def _sph_harm(order, m, polar, azimuth):
+    if hasattr(special, 'sph_harm_y'):
+        return special.sph_harm_y(order, m, polar, azimuth)
+    return special.sph_harm(m, order, azimuth, polar)
+
+
+def _autocorrelation_sums(series, n_lags):
+    """Sums of series(t)*conj(series(t+tau)) over all origins along the last axis with zero padded FFT"""
+    n_fft = fft.next_fast_len(series.shape[-1] + n_lags)
+    if np.iscomplexobj(series):
+        transformed = fft.fft(series, n=n_fft, axis=-1)
+        power = transformed.real**2 + transformed.imag**2
+        return fft.ifft(power, axis=-1)[..., :n_lags].real
+
+    transformed = fft.rfft(series, n=n_fft, axis=-1)
+    power = transformed.real**2 + transformed.imag**2
+    return fft.irfft(power, n=n_fft, axis=-1)[..., :n_lags]
@@ -0,0 +1,52 @@
+"""Numba kernels used by `mdanalysis.correlate`. The kernels are compiled once per data type
+and cached on disk, so that other processes load them instead of compiling again. This module
+is imported only when a kernel is first used"""
+import numpy as np
+from numba import njit, prange
+
+
+@njit(cache=True)
+def legendre(x, order):
+    """Legendre polynomial of the given order from Bonnet's recursion"""
+    if order == 0:
+        return 1.0
+
+    previous = 1.0
+    current = x
+    for n in range(1, order):
+        previous, current = current, ((2*n+1)*x*current - n*previous)/(n+1)
+    return current
+
+
+@njit(cache=True)
+def correlate_legendre(data, order, upper_index):
+    """Sums of P_l(u(k).u(k+lag)) over origins k for vectors of shape (n_frames, 3)"""
+    N = data.shape[0]
+    corr = np.zeros(upper_index)
+
+    for k in range(N):
+        populate_up_to = min(upper_index, N-k)
+        for lag in range(populate_up_to):
+            dot = data[k, 0]*data[k+lag, 0] + data[k, 1]*data[k+lag, 1] + data[k, 2]*data[k+lag, 2]
+            corr[lag] += legendre(dot, order)
+
+    return corr
+
+
+@njit(parallel=True, cache=True)
+def correlate_legendre_batch(data, order, upper_index):
+    """Sums of P_l(u(k).u(k+lag)) over origins k for vectors of shape (n_frames, n_molecules, 3),
+    parallelized over molecules"""
+    N = data.shape[0]
+    n_molecules = data.shape[1]
+    corr = np.zeros((n_molecules, upper_index))
+
+    for mol in prange(n_molecules):
+        for k in range(N):
+            populate_up_to = min(upper_index, N-k)
+            for lag in range(populate_up_to):
+                dot = (data[k, mol, 0]*data[k+lag, mol, 0] + data[k, mol, 1]*data[k+lag, mol, 1]
+                       + data[k, mol, 2]*data[k+lag, mol, 2])
+                corr[mol, lag] += legendre(dot, order)
+
+    return corr
@@ -1,15 +1,19 @@
 """Tools for timeseries analysis"""
 
 import numpy as np
-from scipy import integrate
-from copy import deepcopy
+try:
+    from scipy.integrate import cumulative_trapezoid
+except ImportError:
+    from scipy.integrate import cumtrapz as cumulative_trapezoid
+from copy import copy
 from collections.abc import MutableMapping
 
-from jupytertools import retrieve_from_shelve
+from jupytertools import retrieve_from_shelve, iter_store_chunks
 
 
-__all__ = ['get_time_axis', 'get_time_axis_like', 'integrate_series', 'load_cf',
-           'CorrelationFunction', 'CorrelationFunctions']
+__all__ = ['get_time_axis', 'get_time_axis_like', 'integrate_series', 'running_average',
+           'find_plateau', 'load_cf',
+           'CorrelationFunction', 'CorrelationFunctions', 'StackedCorrelationFunctions']
 
 
 class CorrelationFunctions(MutableMapping):
@@ -45,17 +49,17 @@ class CorrelationFunctions(MutableMapping):
     def __mul__(self, other):
         if type(other) not in [int, float]:
             raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
-        new_cfs = deepcopy(self)
-        for label in new_cfs:
-            new_cfs[label] *= other
+        new_cfs = type(self)()
+        for label, cf_obj in self.cfs.items():
+            new_cfs[label] = cf_obj * other
         return new_cfs
 
     def __truediv__(self, other):
         if type(other) not in [int, float]:
             raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
-        new_cfs = deepcopy(self)
-        for label in new_cfs:
-            new_cfs[label] /= other
+        new_cfs = type(self)()
+        for label, cf_obj in self.cfs.items():
+            new_cfs[label] = cf_obj / other
         return new_cfs
 
     def add(self, cf):
@@ -65,65 +69,511 @@ class CorrelationFunctions(MutableMapping):
         for cf_obj in self.cfs.values():
             cf_obj.dt = dt
 
+    def to_stacked(self):
+        """Copy the cfs into a `StackedCorrelationFunctions`. All cfs need to have the same
+        number of samples and lags and the same time axis"""
+        return StackedCorrelationFunctions(self.cfs)
+
+
+class StackedCorrelationFunctions(CorrelationFunctions):
+    """Collection of cfs with the same number of samples and lags stored in one contiguous
+    array `stack` of shape (n_cfs, n_samples, n_lags). The labels index the first axis.
+
+    It behaves as `CorrelationFunctions`, but scaling, averaging, integrating and slicing
+    are done for all cfs in a single numpy operation. Items are `CorrelationFunction` objects
+    whose samples are views into the stack, created once and reused until the collection
+    is modified. Scaling does not copy the stack, the shared stack is made read-only and
+    replacing a cf copies it first
+
+    All cfs share the time axis. Unless dt or time_axis is given, it is taken from the
+    first cf added, the other cfs must have the same one
+    """
+    def __init__(self, data=(), dt=None, time_axis=None):
+        self.stack = None
+        self.labels = []
+        self.index = {}
+        self.time_step = dt
+        # Time of the first lag, nonzero for slices not starting at the first lag
+        self.time_origin = 0
+        # Non-uniform time axis, such as of cfs from a multi-tau correlator
+        self.time_axis_var = None if time_axis is None else np.asarray(time_axis)
+        self.multiplier = 1
+        self.divisor = 1
+        # Items are created once per stack, so that their cached averages are reused
+        self._items = {}
+        self.update(data)
+
+    @classmethod
+    def from_array(cls, stack, labels, dt=1, time_origin=0, time_axis=None):
+        """Create the collection directly from a 3d array without copying it"""
+        if stack.ndim != 3 or stack.shape[0] != len(labels):
+            raise ValueError(f"Stack of shape {stack.shape} does not match {len(labels)} labels")
+        if time_axis is not None and len(time_axis) != stack.shape[-1]:
+            raise ValueError(f"Time axis of length {len(time_axis)} does not match the stack "
+                             f"with {stack.shape[-1]} lags")
+
+        new_cfs = cls(dt=dt, time_axis=time_axis)
+        new_cfs.time_origin = time_origin
+        new_cfs.stack = stack
+        new_cfs.labels = list(labels)
+        new_cfs.index = {label: i for i, label in enumerate(new_cfs.labels)}
+        return new_cfs
+
+    @property
+    def cfs(self):
+        return {label: self[label] for label in self.labels}
+
+    def __getitem__(self, key):
+        item = self._items.get(key)
+        if item is not None and item[0] is self.stack:
+            return item[1]
+
+        time_axis = None if self.time_axis_var is None and self.time_origin == 0 else self.time_axis
+        cf = CorrelationFunction(self.stack[self.index[key]], key, dt=self.time_step, time_axis=time_axis)
+        cf.multiplier = self.multiplier
+        cf.divisor = self.divisor
+        self._items[key] = (self.stack, cf)
+        return cf
+
+    def __delitem__(self, key):
+        self._items.clear()
+        i_cf = self.index[key]
+        self.stack = np.delete(self.stack, i_cf, axis=0)
+        del self.labels[i_cf]
+        self.index = {label: i for i, label in enumerate(self.labels)}
+
+    def __setitem__(self, key, cf):
+        if key != cf.label:
+            raise ValueError(f"Passed key {key:s} is not the same as the label of the cf object {cf.label:s}")
+
+        self._check_time_axis(cf)
+        self._items.clear()
+        cf_value = cf._samples()
+        if self.multiplier != 1 or self.divisor != 1:
+            cf_value = cf_value * self.divisor / self.multiplier
+
+        if self.stack is None:
+            self.stack = np.array(cf_value)[None, ...]
+        elif cf_value.shape != self.stack.shape[1:]:
+            raise ValueError(f"Cf {key:s} of shape {cf_value.shape} cannot be stacked with cfs "
+                             f"of shape {self.stack.shape[1:]}")
+        elif key in self.index:
+            if not self.stack.flags.writeable:
+                self.stack = self.stack.copy()
+            self.stack[self.index[key]] = cf_value
+            return
+        else:
+            self.stack = np.concatenate((self.stack, cf_value[None, ...]))
+
+        self.index[key] = len(self.labels)
+        self.labels.append(key)
+
+    def _check_time_axis(self, cf):
+        if self.time_step is None:
+            self.time_step = cf.dt
+            if self.time_axis_var is None and cf.time_axis_var is not None:
+                self.time_axis_var = np.asarray(cf.time_axis_var)
+            return
+
+        if cf.time_axis_var is None and self.time_axis_var is None and self.time_origin == 0:
+            same_axis = cf.dt == self.time_step
+        else:
+            n_lags = cf._samples().shape[-1]
+            cf_axis = cf.time_axis_var if cf.time_axis_var is not None else get_time_axis(n_lags, cf.dt)
+            stack_axis = self._lag_times(n_lags)
+            # Cfs with a different number of lags are rejected when stacking
+            same_axis = len(stack_axis) != n_lags or np.allclose(cf_axis, stack_axis)
+        if not same_axis:
+            raise ValueError(f"Cf {cf.label:s} with dt={cf.dt} does not have the same time axis as "
+                             f"the stacked cfs with dt={self.time_step}")
+
+    def __iter__(self):
+        return iter(self.labels)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        repr = f"{type(self).__name__}("
+        for label in self.labels:
+            repr += f"\n{self[label].to_string_short()};"
+
+        repr += ")"
+        return repr
+
+    def __mul__(self, other):
+        if type(other) not in [int, float]:
+            raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
+
+        return self._scaled_copy(other, 1)
+
+    def __truediv__(self, other):
+        if type(other) not in [int, float]:
+            raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
+
+        return self._scaled_copy(1, other)
+
+    def _scaled_copy(self, multiplier, divisor):
+        new_cfs = self._shared_copy(self.stack)
+        new_cfs.multiplier = self.multiplier * multiplier
+        new_cfs.divisor = self.divisor * divisor
+        return new_cfs
+
+    def _shared_copy(self, stack, time_axis=None):
+        # Stack is shared, so neither object may modify it in place from now on
+        if self.stack.flags.writeable:
+            shared = self.stack.view()
+            shared.flags.writeable = False
+            self.stack = shared
+        stack = stack.view()
+        stack.flags.writeable = False
+
+        if time_axis is None:
+            time_axis = self.time_axis_var
+        new_cfs = type(self).from_array(stack, self.labels, self.time_step, self.time_origin, time_axis)
+        new_cfs.multiplier = self.multiplier
+        new_cfs.divisor = self.divisor
+        return new_cfs
+
+    def _apply_scale(self, array):
+        if self.multiplier != 1:
+            array = array * self.multiplier
+            if self.divisor != 1:
+                array /= self.divisor
+        elif self.divisor != 1:
+            array = array / self.divisor
+        return array
+
+    def dt(self, dt):
+        self._items.clear()
+        self.time_step = dt
+
+    @property
+    def time_axis(self):
+        return self._lag_times(self.stack.shape[-1])
+
+    def _lag_times(self, n_lags):
+        if self.time_axis_var is not None:
+            return self.time_axis_var
+        return self.time_origin + get_time_axis(n_lags, self.time_step)
+
+    def average_cfs(self):
+        """Averages of all cfs as an array of shape (n_cfs, n_lags)"""
+        return self._apply_scale(self.stack.mean(axis=1))
+
+    def integrate(self, const=1):
+        """Cumulative integrals of the averages of all cfs, shape (n_cfs, n_lags)"""
+        return integrate_series(self.average_cfs(), self.time_axis, const=const)
+
+    def lag_slice(self, start=None, stop=None, step=None):
+        """View of all cfs restricted to the lags start:stop:step"""
+        first, _, step = slice(start, stop, step).indices(self.stack.shape[-1])
+        time_axis = None if self.time_axis_var is None else self.time_axis_var[start:stop:step]
+        new_cfs = self._shared_copy(self.stack[..., start:stop:step], time_axis)
+        new_cfs.time_origin = self.time_origin + first*self.time_step
+        new_cfs.time_step = self.time_step * step
+        return new_cfs
+
+    def save(self, filename):
+        """Save all cfs as a single block in a `.npz` file. The scale is applied"""
+        time_axis = {} if self.time_axis_var is None else {'time_axis': self.time_axis_var}
+        np.savez(filename, stack=self._apply_scale(self.stack), labels=np.array(self.labels),
+                 dt=self.time_step, time_origin=self.time_origin, **time_axis)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            time_origin = data['time_origin'].item() if 'time_origin' in data else 0
+            time_axis = data['time_axis'] if 'time_axis' in data else None
+            return cls.from_array(data['stack'], data['labels'].tolist(), data['dt'].item(), time_origin,
+                                  time_axis)
+
 
 class CorrelationFunction:
-    def __init__(self, cf_value, label, dt=1):
+    """Correlation function with samples stored as rows of `cf_var`.
+
+    Multiplying or dividing by a number does not copy the samples. The new object shares
+    them with the original one and only stores the scale factor, which is applied when
+    `cf_var` or `average_cf` is read. The shared samples are copied only when `cf_var` of
+    an unscaled cf is read, so that modifying it in place does not change the other cfs
+
+    New samples can be added with `append` and `extend`, which update the mean and variance
+    incrementally. With `keep_samples=False` the samples themselves are dropped and only the
+    running mean and variance are kept, so the memory does not grow with the number of samples
+    """
+    def __init__(self, cf_value, label, dt=1, time_axis=None, keep_samples=True):
         self.label = label
         self.dt = dt
+        self.keep_samples = keep_samples
 
-        if len(cf_value.shape) == 1:
+        if cf_value is not None and len(cf_value.shape) == 1:
             cf_value = cf_value[None, ...]
         self.cf_var = cf_value
 
+        if time_axis is not None and cf_value is not None and len(time_axis) != cf_value.shape[-1]:
+            raise ValueError(f"Time axis of length {len(time_axis)} does not match the cf "
+                             f"with {cf_value.shape[-1]} lags")
+        self.time_axis_var = time_axis
+
     def __repr__(self):
         prefix = f"{type(self).__name__}('{self.label}': "
         suffix = f", dt={self.dt})"
-        cf_repr = np.array2string(self.cf_var, edgeitems=2, prefix=prefix, suffix=suffix)
+        cf_repr = np.array2string(self._repr_array(), edgeitems=2, prefix=prefix, suffix=suffix)
         return f"{prefix}{cf_repr}{suffix}"
 
     def __mul__(self, other):
+        """Scaled cf sharing the samples with this one. The samples are copied only when
+        `cf_var` of an unscaled cf sharing them is read"""
         if type(other) not in [int, float]:
             raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
 
-        new_cf = deepcopy(self)
-        if hasattr(self, 'average_cf_var'):
-            del new_cf.average_cf_var
-
-        new_cf.cf_var *= other
-        return new_cf
+        return self._scaled_copy(other, 1)
 
     def __truediv__(self, other):
+        """Scaled cf sharing the samples with this one. The samples are copied only when
+        `cf_var` of an unscaled cf sharing them is read"""
         if type(other) not in [int, float]:
             raise TypeError(f"unsupported operand type(s) for *: {type(self).__name__} and {type(other).__name__}")
 
-        new_cf = deepcopy(self)
-        if hasattr(self, 'average_cf_var'):
-            del new_cf.average_cf_var
+        return self._scaled_copy(1, other)
+
+    def _scaled_copy(self, multiplier, divisor):
+        self._merge_pending()
+
+        # Shared samples are protected, cf_var copies them before they can be modified
+        if self.cf_raw is not None and self.cf_raw.flags.writeable:
+            shared = self.cf_raw.view()
+            shared.flags.writeable = False
+            self.cf_raw = shared
+            self._shared_raw = True
 
-        new_cf.cf_var /= other
+        new_cf = copy(self)
+        new_cf._pending_rows = []
+        new_cf.multiplier = self.multiplier * multiplier
+        new_cf.divisor = self.divisor * divisor
+        new_cf._scaled_var = None
+        new_cf._average_var = None
         return new_cf
 
+    @property
+    def cf_var(self):
+        samples = self._samples()
+        if self._shared_raw and samples is self.cf_raw:
+            self.cf_raw = samples = samples.copy()
+            self._shared_raw = False
+        return samples
+
+    def _samples(self):
+        """Scaled samples without copying the shared ones, which are read-only"""
+        if not self.keep_samples:
+            raise ValueError(f"Samples of the cf '{self.label}' are not kept, only their statistics")
+
+        self._merge_pending()
+        if self.multiplier == 1 and self.divisor == 1:
+            return self.cf_raw
+
+        if self._scaled_var is None:
+            self._scaled_var = self._apply_scale(self.cf_raw)
+        return self._scaled_var
+
+    @cf_var.setter
+    def cf_var(self, cf_value):
+        self.cf_raw = cf_value
+        self._shared_raw = False
+        self.multiplier = 1
+        self.divisor = 1
+        self._pending_rows = []
+        self._scaled_var = None
+        self._average_var = None
+        # Unscaled statistics shared by all scaled copies of the samples
+        self._raw_stats = {}
+
+        if not self.keep_samples:
+            self._statistics()
+            self.cf_raw = None
+
+    @property
+    def scale(self):
+        """Scale factor applied to the stored samples"""
+        return self.multiplier / self.divisor
+
+    def _apply_scale(self, array):
+        if self.multiplier != 1:
+            array = array * self.multiplier
+            if self.divisor != 1:
+                array /= self.divisor
+        elif self.divisor != 1:
+            array = array / self.divisor
+        return array
+
+    def _merge_pending(self):
+        if self._pending_rows:
+            rows = self._pending_rows if self.cf_raw is None else [self.cf_raw] + self._pending_rows
+            self.cf_raw = np.concatenate(rows)
+            self._shared_raw = False
+            self._pending_rows = []
+
+    def _statistics(self):
+        """Unscaled number of samples, mean and sum of squared deviations from the mean"""
+        if 'm2' not in self._raw_stats:
+            # Pending rows are combined chunk by chunk, so they are not concatenated
+            chunks = self._pending_rows if self.cf_raw is None else [self.cf_raw] + self._pending_rows
+            stats = {'n': 0}
+            for chunk in chunks:
+                stats = _merge_statistics(stats, _chunk_statistics(chunk))
+
+            if 'mean' in self._raw_stats:
+                stats['mean'] = self._raw_stats['mean']
+            elif stats['n'] > 0:
+                stats['mean'] = _read_only(stats['mean'])
+            self._raw_stats = stats
+        return self._raw_stats
+
+    def append(self, cf_row):
+        """Add a single sample, for instance result of a new replica"""
+        self.extend(np.asarray(cf_row)[None, ...])
+
+    def extend(self, cf_rows):
+        """Add samples as rows of a 2d array. The mean and variance are updated by combining
+        the statistics of the new rows with the current ones (Chan's parallel Welford update)"""
+        cf_rows = np.asarray(cf_rows)
+        if cf_rows.ndim == 1:
+            cf_rows = cf_rows[None, ...]
+
+        stats = self._statistics()
+        if stats['n'] > 0 and cf_rows.shape[1:] != stats['mean'].shape:
+            raise ValueError(f"Samples with {cf_rows.shape[-1]} lags cannot be added to the cf "
+                             f"with {stats['mean'].shape[-1]} lags")
+
+        raw_rows = cf_rows
+        if self.multiplier != 1 or self.divisor != 1:
+            raw_rows = cf_rows * self.divisor / self.multiplier
+
+        # New objects, so that scaled copies sharing the old ones are not affected
+        stats = _merge_statistics(stats, _chunk_statistics(raw_rows))
+        self._raw_stats = {'n': stats['n'], 'mean': _read_only(stats['mean']), 'm2': stats['m2']}
+        if self.keep_samples:
+            self._pending_rows.append(raw_rows)
+        self._scaled_var = None
+        self._average_var = None
+
+    def _extend_lazy(self, cf_rows):
+        """Add samples without reading them, the statistics are computed on demand"""
+        self._pending_rows.append(cf_rows if cf_rows.ndim > 1 else cf_rows[None, ...])
+        self._raw_stats = {}
+        self._scaled_var = None
+        self._average_var = None
+
+    def _repr_array(self):
+        return self._samples() if self.keep_samples else self.average_cf
+
     def to_string_short(self):
         prefix = f"'{self.label}': "
         suffix = f", dt={self.dt}"
-        cf_repr = np.array2string(self.cf_var, edgeitems=2, prefix=prefix, suffix=suffix)
+        cf_repr = np.array2string(self._repr_array(), edgeitems=2, prefix=prefix, suffix=suffix)
         return f"{prefix}{cf_repr}{suffix}"
 
+    @property
+    def n_samples(self):
+        if 'n' in self._raw_stats:
+            return self._raw_stats['n']
+        n_raw = 0 if self.cf_raw is None else self.cf_raw.shape[0]
+        return n_raw + sum(rows.shape[0] for rows in self._pending_rows)
+
+    @property
+    def time_axis(self):
+        """Time axis of the cf. For cfs evaluated at non-uniform lags (such as from a
+        multi-tau correlator) this is the time axis passed on creation, otherwise it is
+        derived from `dt`"""
+        if self.time_axis_var is not None:
+            return self.time_axis_var
+
+        return get_time_axis(self.average_cf.shape[-1], self.dt)
+
     @property
     def average_cf(self):
-        if hasattr(self, 'average_cf_var'):
-            return self.average_cf_var
+        if self._average_var is not None:
+            return self._average_var
+
+        if self.n_samples == 0:
+            raise ValueError(f"The cf '{self.label}' has no samples")
+
+        if 'mean' not in self._raw_stats:
+            if self._pending_rows:
+                self._statistics()
+            else:
+                self._raw_stats['mean'] = _read_only(self.cf_raw.mean(axis=0))
+
+        # Shared mean is read-only, the average of an unscaled cf is its own copy
+        if self.multiplier == 1 and self.divisor == 1:
+            self._average_var = self._raw_stats['mean'].copy()
+        else:
+            self._average_var = self._apply_scale(self._raw_stats['mean'])
+        return self._average_var
+
+    @property
+    def variance_cf(self):
+        """Sample variance of the cf at every lag"""
+        stats = self._statistics()
+        if stats['n'] < 2:
+            raise ValueError(f"The cf '{self.label}' needs at least 2 samples for the variance")
+        return stats['m2'] / (stats['n'] - 1) * self.scale**2
+
+    @property
+    def stderr_cf(self):
+        """Standard error of the average cf at every lag"""
+        return np.sqrt(self.variance_cf / self.n_samples)
+
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+
+def _chunk_statistics(rows):
+    mean = rows.mean(axis=0, dtype=np.float64)
+    return {'n': rows.shape[0], 'mean': mean, 'm2': ((rows - mean)**2).sum(axis=0)}
 
-        self.average_cf_var = self.cf_var.mean(axis=0)
-        return self.average_cf_var
 
+def _merge_statistics(stats_a, stats_b):
+    """Combine the statistics of two sets of samples (Chan's parallel Welford update)"""
+    if stats_a['n'] == 0:
+        return stats_b
+    if stats_b['n'] == 0:
+        return stats_a
 
-def load_cf(filename, key, foldername='shelve', label=None):
+    n = stats_a['n'] + stats_b['n']
+    delta = stats_b['mean'] - stats_a['mean']
+    mean = stats_a['mean'] + delta*stats_b['n']/n
+    m2 = stats_a['m2'] + stats_b['m2'] + delta**2*stats_a['n']*stats_b['n']/n
+    return {'n': n, 'mean': mean, 'm2': m2}
+
+
+def load_cf(filename, key, foldername='shelve', label=None, store=False, keep_samples=True, cache=False):
+    """Load cf saved with `save_to_shelve`, or with `save_to_store` if store is True.
+    With cache=True the samples retrieved from shelve are cached, see `retrieve_from_shelve`.
+
+    From a store the cf is read lazily: the memory-mapped chunks are only referenced, with
+    their original dtype, and the mean and variance are computed chunk by chunk on the first
+    access to `average_cf` or `variance_cf`. The samples are concatenated into memory on the
+    first access to `cf_var`. Compressed stores have to be decompressed chunk by chunk when
+    loading. With keep_samples=False all chunks are read once when loading to compute the
+    statistics and the samples are not kept
+    """
     if not label:
         label = f"{filename:s} {key:s}".replace("_", " ")
 
-    cf_value = retrieve_from_shelve(filename, key, foldername)
-    return CorrelationFunction(cf_value, label)
+    if not store:
+        cf_value = retrieve_from_shelve(filename, key, foldername, cache=cache)
+        return CorrelationFunction(cf_value, label)
+
+    cf = CorrelationFunction(None, label, keep_samples=keep_samples)
+    for chunk in iter_store_chunks(filename, key, foldername):
+        if keep_samples:
+            cf._extend_lazy(chunk)
+        else:
+            cf.extend(chunk)
+    return cf
 
 
 def get_time_axis(n_frames, dt):
@@ -161,28 +611,107 @@ def get_time_axis_like(y_axis, dt):
 
 
 def integrate_series(series, time_axis=None, const=1, dt=1, weights=None):
-    """Integrate series using integrate.cumtrapz. Weights for the integral can be used
+    """Cumulatively integrate series along the last axis. A 2d array is treated as a stack
+    of series (e.g. `cf_var` or averages of all cfs) integrated in a single pass. Weights for
+    the integral can be used
 
     Parameters
     ----------
-    series : array-like object containing the series to be integrated
-    time_axis : time axis for the series
+    series : array-like object containing the series to be integrated, either 1d or 2d
+        with one series per row
+    time_axis : time axis for the series, common to all rows
     const : const to multiply the whole integral by
-    weights : weights for the integrand, optional
+    dt : time step used when time_axis is not given
+    weights : weights for the integrand of the same shape as series, optional
 
     Returns
     -------
-    integral : the integrated series
+    integral : the integrated series of the same shape as series
 
     """
-    if weights is None:
-        weights = np.full_like(series, 1)
-    elif weights.shape != series.shape:
-        error_msg_format = "The weights with shape {} are not compatible with the series of shape {}"
-        raise ValueError(error_msg_format.format(weights.shape, series.shape))
+    series = np.asarray(series)
+    if weights is not None:
+        if weights.shape != series.shape:
+            error_msg_format = "The weights with shape {} are not compatible with the series of shape {}"
+            raise ValueError(error_msg_format.format(weights.shape, series.shape))
+        series = series*weights
 
     if time_axis is None:
-        time_axis = get_time_axis_like(series, dt)
+        time_axis = get_time_axis(series.shape[-1], dt)
+
+    integral = cumulative_trapezoid(series, time_axis, axis=-1, initial=0)
+    if const != 1:
+        integral *= const
+    return integral
+
+
+def running_average(series, window):
+    """Running average over `window` consecutive values along the last axis
+
+    Parameters
+    ----------
+    series : 1d or 2d array, rows are averaged independently
+    window : number of values in the averaging window
+
+    Returns
+    -------
+    average : array with the last axis shorter by window-1, the value at index i is the
+        average of series[..., i:i+window]
+
+    """
+    series = np.asarray(series, dtype=np.float64)
+    cumsum = np.cumsum(series, axis=-1)
+    average = cumsum[..., window-1:].copy()
+    average[..., 1:] -= cumsum[..., :-window]
+    average /= window
+    return average
+
 
-    integrand = const*series
-    return integrate.cumtrapz(integrand*weights, time_axis, initial=0)
+def find_plateau(integrals, window, tolerance=0.01, time_axis=None, dt=1, closest=False):
+    """Find plateaus of running integrals, such as Green-Kubo integrals of transport
+    coefficients. The plateau is the first window whose running average differs from the one
+    of the previous window by less than the relative tolerance. All rows of a 2d array are
+    processed at once. This is the plateau criterion used throughout the repository, e.g. by
+    `lammpstools.GreenKuboStream`
+
+    Parameters
+    ----------
+    integrals : 1d or 2d array with the running integrals in rows
+    window : number of values in the averaging window
+    tolerance : maximal relative change between two consecutive windows
+    time_axis : time axis of the integrals, common to all rows
+    dt : time step used when time_axis is not given
+    closest : where no window is within the tolerance, use the window with the smallest
+        relative change instead of returning nan
+
+    Returns
+    -------
+    values : plateau value of every row, nan where no plateau was found
+    times : time at the middle of the plateau window, nan where no plateau was found
+
+    """
+    integrals = np.asarray(integrals)
+    if time_axis is None:
+        time_axis = get_time_axis(integrals.shape[-1], dt)
+    if integrals.shape[-1] < 2*window:
+        raise ValueError(f"Series with {integrals.shape[-1]} values is too short for two windows of {window}")
+
+    average = running_average(integrals, window)
+    current = average[..., window:]
+    previous = average[..., :-window]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = np.abs(current - previous) / np.abs(current)
+    flat = change <= tolerance
+
+    found = flat.any(axis=-1)
+    first = flat.argmax(axis=-1)
+    if closest:
+        change = np.where(np.isnan(change), np.inf, change)
+        first = np.where(found, first, change.argmin(axis=-1))
+        found = found | np.isfinite(change.min(axis=-1))
+    values = np.take_along_axis(current, first[..., None], axis=-1)[..., 0]
+    times = np.asarray(time_axis)[first + window + (window-1)//2]
+
+    values = np.where(found, values, np.nan)
+    times = np.where(found, times, np.nan)
+    return values, times
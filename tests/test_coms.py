@@ -0,0 +1,56 @@
+import numpy as np
+import mdtraj as md
+from lammpstools import mdt
+
+
+def mixture_topology():
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for _ in range(3):
+        water = topology.add_residue('HOH', chain)
+        for name, element in [('O', md.element.oxygen), ('H1', md.element.hydrogen), ('H2', md.element.hydrogen)]:
+            topology.add_atom(name, element, water)
+        ion = topology.add_residue('NA', chain)
+        topology.add_atom('NA', md.element.sodium, ion)
+    return topology
+
+
+def test_get_coms_homogeneous():
+    rng = np.random.default_rng(0)
+    xyz = rng.random((11, 30, 3), dtype=np.float32)
+    masses = [15.999, 1.008, 1.008]
+
+    indeces_mols = np.arange(30).reshape(10, 3)
+    expected = np.average(xyz[:, indeces_mols], axis=2, weights=masses)
+
+    assert np.allclose(mdt.get_coms(xyz, masses, chunk=4), expected)
+
+
+def test_get_coms_mols_mixture():
+    rng = np.random.default_rng(1)
+    topology = mixture_topology()
+    xyz = rng.random((7, topology.n_atoms, 3))
+    masses = np.array([atom.element.mass for atom in topology.atoms])
+
+    coms = mdt.get_coms_mols(xyz, topology, chunk=3)
+
+    assert coms.shape == (7, 6, 3)
+    for i, residue in enumerate(topology.residues):
+        indices = [atom.index for atom in residue.atoms]
+        expected = np.average(xyz[:, indices], axis=1, weights=masses[indices])
+        assert np.allclose(coms[:, i], expected)
+
+
+def test_get_coms_mols_groups_out():
+    rng = np.random.default_rng(2)
+    topology = mixture_topology()
+    xyz = rng.random((5, topology.n_atoms, 3))
+    masses = np.array([atom.element.mass for atom in topology.atoms])
+    groups = [[4, 5, 6], [0, 3, 7]]
+    out = np.zeros((5, 2, 3))
+
+    coms = mdt.get_coms_mols(xyz, topology, groups=groups, chunk=2, out=out)
+
+    assert coms is out
+    for i, group in enumerate(groups):
+        assert np.allclose(coms[:, i], np.average(xyz[:, group], axis=1, weights=masses[group]))
@@ -95,3 +95,177 @@ def test_cf_multiplication_average():
     tested_32f = np.array(new_avg, dtype=np.float32)
 
     assert (correct_32f == tested_32f).all()
+
+
+def test_cf_scaling_is_lazy():
+    cf_var = np.random.random((100, 1000))
+    cf = md.CorrelationFunction(cf_var, "cf")
+    original_avg = cf.average_cf
+
+    cf_new = (cf * 3.0) / 2.0
+
+    assert np.shares_memory(cf_new.cf_raw, cf.cf_raw)
+    assert cf_new.scale == 1.5
+    assert np.allclose(cf_new.average_cf, original_avg * 1.5)
+    assert np.allclose(cf_new.cf_var, cf_var * 1.5)
+    # Unscaled mean is computed only once for both objects
+    assert cf_new._raw_stats['mean'] is cf._raw_stats['mean']
+
+
+def test_cf_shared_samples_are_copied_on_write():
+    cf = md.CorrelationFunction(np.random.random((10, 100)), "cf")
+    cf_new = cf * 2.0
+    assert np.shares_memory(cf_new.cf_raw, cf.cf_raw)
+    repr(cf)
+    assert np.shares_memory(cf_new.cf_raw, cf.cf_raw)
+
+    cf.cf_var[0, 0] = 1.0
+    assert cf.cf_var[0, 0] == 1.0
+    assert cf_new.cf_var[0, 0] != 2.0
+
+    cf_same = cf_new / 2.0
+    cf_same.cf_var[0, 1] = 1.0
+    assert cf_new.cf_var[0, 1] != 2.0
+
+
+def test_cf_extend_matches_batch_statistics():
+    samples = np.random.random((60, 200))
+    cf = md.CorrelationFunction(samples[:10], "cf")
+    cf.average_cf
+    cf.extend(samples[10:45])
+    for row in samples[45:]:
+        cf.append(row)
+
+    assert cf.n_samples == 60
+    assert np.allclose(cf.cf_var, samples)
+    assert np.allclose(cf.average_cf, samples.mean(axis=0))
+    assert np.allclose(cf.variance_cf, samples.var(axis=0, ddof=1))
+
+    cf_scaled = cf * 2.0
+    cf_scaled.append(2*samples[0])
+    assert cf.n_samples == 60
+    assert np.allclose(cf_scaled.average_cf, 2*np.vstack((samples, samples[:1])).mean(axis=0))
+
+
+def test_cf_fixed_memory_mode():
+    samples = np.random.random((50, 100))
+    cf = md.CorrelationFunction(None, "cf", keep_samples=False)
+    for block in np.array_split(samples, 7):
+        cf.extend(block)
+
+    assert cf.cf_raw is None
+    assert np.allclose(cf.average_cf, samples.mean(axis=0))
+    assert np.allclose(cf.stderr_cf, samples.std(axis=0, ddof=1) / np.sqrt(50))
+    with pytest.raises(ValueError):
+        cf.cf_var
+
+
+def test_stacked_cfs_match_dict_backend(tmp_path):
+    cfs = init_correlationfunctions()
+    stacked = cfs.to_stacked()
+
+    assert list(stacked) == list(cfs)
+    assert stacked.stack.shape == (2, 100, 1000)
+
+    scale = np.random.random()
+    stacked_new = stacked * scale
+    assert np.shares_memory(stacked_new.stack, stacked.stack)
+    for cf_key in cfs:
+        assert np.allclose(stacked_new[cf_key].cf_var, cfs[cf_key].cf_var * scale)
+        assert np.allclose(stacked_new.average_cfs()[stacked.index[cf_key]],
+                           (cfs[cf_key] * scale).average_cf)
+
+    sliced = stacked_new.lag_slice(0, 500, 2)
+    assert sliced.stack.shape == (2, 100, 250)
+    assert np.allclose(sliced.time_axis, stacked.time_axis[:500:2])
+
+    stacked.dt(0.5)
+    shifted = stacked.lag_slice(100, 200).lag_slice(10, None, 3)
+    assert np.allclose(shifted.time_axis, stacked.time_axis[110:200:3])
+    assert np.allclose(shifted["cf1"].time_axis, stacked.time_axis[110:200:3])
+    shifted.save(tmp_path / "shifted.npz")
+    assert np.allclose(md.StackedCorrelationFunctions.load(tmp_path / "shifted.npz").time_axis,
+                       shifted.time_axis)
+
+    stacked_new.save(tmp_path / "cfs.npz")
+    loaded = md.StackedCorrelationFunctions.load(tmp_path / "cfs.npz")
+    assert np.allclose(loaded.stack, stacked_new.stack * scale)
+
+    del loaded["cf1"]
+    assert list(loaded) == ["cf2"]
+    with pytest.raises(ValueError):
+        loaded.add(md.CorrelationFunction(np.random.random((10, 1000)), "cf3"))
+
+
+def test_stacked_cfs_keep_time_axis():
+    samples = np.random.random((2, 10, 50))
+    cfs = md.CorrelationFunctions()
+    cfs.add(md.CorrelationFunction(samples[0], "a", dt=0.5))
+    cfs.add(md.CorrelationFunction(samples[1], "b", dt=0.5))
+    stacked = cfs.to_stacked()
+    assert stacked["a"].dt == 0.5
+    assert np.allclose(stacked.integrate()[0], md.integrate_series(cfs["a"].average_cf, dt=0.5))
+    with pytest.raises(ValueError):
+        stacked.add(md.CorrelationFunction(samples[0], "c"))
+
+    cfs.add(md.CorrelationFunction(samples[0], "c"))
+    with pytest.raises(ValueError):
+        cfs.to_stacked()
+
+    time_axis = np.geomspace(1, 100, 50)
+    multitau = md.CorrelationFunctions()
+    multitau.add(md.CorrelationFunction(samples[0], "a", time_axis=time_axis))
+    multitau.add(md.CorrelationFunction(samples[1], "b", time_axis=time_axis))
+    stacked = multitau.to_stacked()
+    assert np.array_equal(stacked.time_axis, time_axis)
+    assert np.array_equal(stacked["b"].time_axis, time_axis)
+    assert np.array_equal(stacked.lag_slice(5, None, 2)["a"].time_axis, time_axis[5::2])
+    with pytest.raises(ValueError):
+        stacked.add(md.CorrelationFunction(samples[0], "c"))
+
+
+def test_integrate_series_batched():
+    time_axis = md.get_time_axis(500, 0.1)
+    decays = np.array([0.5, 1.0, 2.0])[:, None]
+    series = np.exp(-time_axis / decays)
+
+    integrals = md.integrate_series(series, time_axis, const=2)
+    for row, integral in zip(series, integrals):
+        assert np.allclose(integral, md.integrate_series(row, dt=0.1, const=2))
+
+    weights = np.full_like(series, 0.5)
+    assert np.allclose(md.integrate_series(series, time_axis, const=2, weights=weights), integrals / 2)
+
+    values, times = md.find_plateau(integrals, 20, tolerance=1e-3, time_axis=time_axis)
+    assert np.allclose(values, 2*decays[:, 0], rtol=1e-2)
+    assert (np.diff(times) > 0).all()
+
+    values, _ = md.find_plateau(time_axis[None, :], 20, tolerance=1e-3)
+    assert np.isnan(values).all()
+
+    values, times = md.find_plateau(time_axis[None, :], 20, tolerance=1e-3, closest=True)
+    assert np.isfinite(values).all() and np.isfinite(times).all()
+
+
+def test_cf_average_is_not_shared_mutably():
+    cf = md.CorrelationFunction(np.ones((5, 10)), "cf")
+    avg = cf.average_cf
+
+    avg -= avg[-1]
+    assert np.allclose(cf.average_cf, 0.0)
+    assert np.allclose((cf * 2.0).average_cf, 2.0)
+
+
+def test_cf_empty_and_copies_do_not_share_new_rows():
+    empty = md.CorrelationFunction(None, "cf", keep_samples=False)
+    with pytest.raises(ValueError, match="no samples"):
+        empty.average_cf
+
+    cf = md.CorrelationFunction(np.ones((2, 10)), "cf")
+    cf_scaled = cf * 2.0
+    cf.append(np.zeros(10))
+    cf_scaled.append(np.full(10, 2.0))
+
+    assert cf.n_samples == 3 and cf_scaled.n_samples == 3
+    assert np.allclose(cf.cf_var[-1], 0.0)
+    assert np.allclose(cf_scaled.cf_var[-1], 2.0)
@@ -0,0 +1,60 @@
+import gc
+
+import numpy as np
+import mdanalysis as md
+from jupytertools import decimation
+
+
+def test_log_decimate_keeps_ends():
+    x = np.arange(100000, dtype=np.float64)
+    y = np.exp(-x / 1000)
+
+    x_dec, y_dec = decimation.log_decimate(x, y, 500)
+
+    assert len(x_dec) <= 500
+    assert x_dec[0] == 0 and x_dec[-1] == x[-1]
+    assert (np.diff(x_dec) > 0).all()
+
+
+def test_lttb_keeps_spike():
+    x = np.arange(10000, dtype=np.float64)
+    y = np.zeros_like(x)
+    y[4321] = 10.0
+
+    x_dec, y_dec = decimation.lttb_decimate(x, y, 100)
+
+    assert len(x_dec) == 100
+    assert 4321 in x_dec
+    assert y_dec.max() == 10.0
+
+
+def test_decimate_cf_is_cached():
+    decimation.clear_decimation_cache()
+    cf = md.CorrelationFunction(np.random.random((10, 10000)), "cf")
+
+    first = decimation.decimate_cf(cf, 'lttb', 200)
+    second = decimation.decimate_cf(cf, 'lttb', 200)
+
+    assert first is second
+    assert decimation.decimate_cf(cf * 2.0, 'lttb', 200) is not first
+
+
+def test_decimation_cache_does_not_keep_sources_alive():
+    decimation.clear_decimation_cache()
+    cf = md.CorrelationFunction(np.random.random((10, 10000)), "cf")
+    decimation.decimate_cf(cf, 'log', 100)
+    assert len(decimation._decimation_cache) == 1
+
+    del cf
+    gc.collect()
+    assert len(decimation._decimation_cache) == 0
+
+    stacked = md.CorrelationFunctions([("a", md.CorrelationFunction(np.random.random((5, 5000)), "a"))]).to_stacked()
+    for _ in range(3):
+        result = decimation.decimate_cf(stacked["a"], 'log', 100)
+    assert decimation.decimate_cf(stacked["a"], 'log', 100) is result
+    assert len(decimation._decimation_cache) == 1
+
+    # Lists cannot be weakly referenced and are decimated without caching
+    x_dec, _ = decimation.decimate_cached(list(range(1000)), list(range(1000)), 'log', 50)
+    assert len(x_dec) <= 50
@@ -0,0 +1,45 @@
+import pytest
+
+import numpy as np
+from scipy import special
+import mdanalysis as md
+
+
+def random_rotation(n_frames=300, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = np.cumsum(rng.normal(scale=0.2, size=(n_frames, 3)), axis=0) + 1.0
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize("order", [1, 2])
+def test_fft_legendre_matches_numba(order):
+    data = random_rotation()
+
+    direct = md.prepare_numba_correlation(md.prepare_legendre(order))
+    fft = md.prepare_fft_correlation(order)
+
+    assert np.allclose(direct(data, 0.5, False, 40.0), fft(data, 0.5, False, 40.0))
+    assert np.allclose(direct(data, 0.5, True), fft(data, 0.5, True))
+
+
+def test_fft_legendre_spherical_harmonics():
+    data = random_rotation(n_frames=150)
+    n_lags = 30
+
+    expected = np.array([special.eval_legendre(3, (data[:data.shape[0]-lag]*data[lag:]).sum(axis=1)).mean()
+                         for lag in range(n_lags)])
+    result = md.prepare_fft_correlation(3)(data, 1.0, upper_acf_time=n_lags-1)
+
+    assert np.allclose(result, expected)
+
+
+def test_correlate_molecules():
+    data = np.stack([random_rotation(n_frames=120, seed=seed) for seed in range(4)], axis=1)
+
+    cf = md.correlate_molecules(data, 0.5, 2, "P2", upper_acf_time=20.0)
+    single = md.prepare_numba_correlation(md.prepare_legendre(2))
+
+    assert cf.cf_var.shape == (4, 41)
+    for mol in range(4):
+        assert np.allclose(cf.cf_var[mol], single(data[:, mol], 0.5, False, 20.0))
+    assert np.allclose(cf.average_cf, cf.cf_var.mean(axis=0))
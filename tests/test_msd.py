@@ -0,0 +1,109 @@
+import pytest
+
+import numpy as np
+from lammpstools import mdt
+
+
+def random_walk(n_frames=400, n_atoms=20, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(scale=0.1, size=(n_frames, n_atoms, 3))
+    return np.cumsum(steps, axis=0)
+
+
+def test_msd_fft_matches_direct():
+    xyz = random_walk()
+    n_frames = xyz.shape[0]
+    dt = 2
+
+    x_old, msd_old = mdt.msd_raw_old(xyz, dt, n_frames, upper=100*dt)
+    x_fft, msd_fft = mdt.msd_raw(xyz, dt, None, upper=100*dt, method='fft')
+
+    assert (x_old == x_fft).all()
+    assert np.allclose(msd_old, msd_fft)
+
+
+def test_msd_fft_per_atom():
+    xyz = random_walk().astype(np.float32)
+    n_frames = xyz.shape[0]
+
+    _, msd_old = mdt.msd_raw_old(xyz, 1, n_frames, average=False)
+    _, msd_fft = mdt.msd_raw(xyz, 1, None, average=False, method='fft')
+
+    assert msd_fft.shape == msd_old.shape
+    assert np.allclose(msd_old, msd_fft, rtol=1e-4, atol=1e-5)
+
+
+def test_msd_fft_upper_too_long():
+    xyz = random_walk(n_frames=10)
+    with pytest.raises(ValueError):
+        mdt.msd_raw(xyz, 1, None, upper=20, method='fft')
+
+
+@pytest.mark.parametrize("spacing", [1, 3])
+def test_msd_stream_matches_direct(spacing):
+    xyz = random_walk(n_frames=300)
+    dt = 2
+    chunks = np.array_split(xyz, 7)
+
+    _, msd_direct = mdt.msd_raw(xyz, dt, None, spacing=spacing, upper=50*dt, average=False)
+    _, msd_streamed = mdt.msd_stream(chunks, dt, 50*dt, spacing=spacing, average=False)
+
+    assert np.allclose(msd_direct, msd_streamed)
+
+
+def test_msd_multitau_matches_direct():
+    xyz = random_walk(n_frames=256)
+
+    lags, msd_tau = mdt.msd_multitau(xyz, 1, block_length=16, averaging=2)
+    _, msd_fine = mdt.msd_raw(xyz, 1, None, upper=16, method='fft')
+    _, msd_coarse = mdt.msd_raw(xyz[::2], 2, None, upper=64, method='fft')
+
+    assert (lags[:16] == np.arange(16)).all()
+    assert (lags[16:24] == np.arange(16, 32, 2)).all()
+    assert np.allclose(msd_tau[:16], msd_fine)
+    assert np.allclose(msd_tau[16:24], msd_coarse[8:16])
+    assert (np.diff(lags) > 0).all()
+
+
+def test_msd_numba_matches_numpy():
+    xyz = random_walk(n_frames=200)
+
+    _, msd_numpy = mdt.msd_raw(xyz, 1, None, spacing=4, upper=60, average=False)
+    _, msd_numba = mdt.msd_raw(xyz, 1, None, spacing=4, upper=60, average=False, engine='numba')
+
+    assert np.allclose(msd_numpy, msd_numba)
+
+
+def test_msd_moments():
+    xyz = random_walk(n_frames=200)
+
+    _, msd_atoms = mdt.msd_raw(xyz, 1, None, spacing=2, upper=40, average=False)
+    _, stats = mdt.msd_moments(xyz, 1, None, spacing=2, upper=40, per_atom=True, dtype=np.float32)
+
+    assert stats['msd_atoms'].dtype == np.float32
+    assert np.allclose(stats['msd'], msd_atoms.mean(axis=1))
+    assert np.allclose(stats['msd_atoms'], msd_atoms, rtol=1e-5)
+    assert np.allclose(stats['atom_variance'], msd_atoms.var(axis=1), rtol=1e-4)
+    # Gaussian displacements of a random walk
+    assert np.abs(stats['alpha2'][1:]).max() < 0.3
+
+
+def test_msd_parallel_matches_serial():
+    xyz = random_walk(n_frames=200).astype(np.float32)
+
+    _, msd_serial = mdt.msd_raw(xyz, 1, None, spacing=3, upper=50, average=False)
+    _, msd_parallel = mdt.msd_raw_parallel(xyz, 1, None, spacing=3, upper=50, average=False,
+                                           max_workers=2, n_blocks=5)
+
+    assert np.allclose(msd_serial, msd_parallel)
+
+
+def test_msd_fft_float32_large_offset():
+    xyz = (random_walk(n_frames=300) + 30.0).astype(np.float32)
+
+    _, msd_old = mdt.msd_raw_old(xyz, 1, xyz.shape[0], upper=50, average=False)
+    _, msd_fft = mdt.msd_raw(xyz, 1, None, upper=50, average=False, method='fft')
+    msd_blocks = mdt._msd_fft(xyz, 50, atom_block=3)
+
+    assert np.allclose(msd_old, msd_fft, rtol=1e-3, atol=1e-5)
+    assert np.allclose(msd_fft, msd_blocks)
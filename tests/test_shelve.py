@@ -0,0 +1,147 @@
+import threading
+
+import pytest
+
+import numpy as np
+import mdanalysis as md
+import jupytertools as jt
+
+
+@pytest.fixture
+def shelve_folder(tmp_path):
+    jt.clear_shelve_cache()
+    yield tmp_path
+    jt.clear_shelve_cache()
+
+
+def test_shelve_cache_hits_and_invalidation(shelve_folder):
+    array = np.random.random((20, 30))
+    jt.save_dict_to_shelve("results", {"cf": array, "other": [1, 2]}, foldername=shelve_folder)
+
+    first = jt.retrieve_from_shelve("results", "cf", shelve_folder, cache=True)
+    second = jt.retrieve_from_shelve("results", "cf", shelve_folder, cache=True)
+    assert first is second
+    assert not first.flags.writeable
+    assert jt.shelve_cache_info()['hits'] == 1
+    assert jt.shelve_cache_info()['misses'] == 1
+
+    jt.save_to_shelve("results", "cf", 2*array, foldername=shelve_folder)
+    assert np.allclose(jt.retrieve_from_shelve("results", "cf", shelve_folder, cache=True), 2*array)
+
+    cf = md.load_cf("results", "cf", foldername=shelve_folder, cache=True)
+    assert np.allclose(cf.average_cf, 2*array.mean(axis=0))
+    assert jt.shelve_cache_info()['hits'] == 2
+
+
+def test_shelve_cache_missing_key(shelve_folder):
+    jt.save_to_shelve("results", "cf", 1, foldername=shelve_folder)
+
+    for cache in (False, True):
+        with pytest.raises(KeyError) as error:
+            jt.retrieve_from_shelve("results", "missing", shelve_folder, cache=cache)
+        assert error.value.args == ("missing",)
+
+
+def test_shelve_cache_is_bounded(shelve_folder):
+    arrays = {f"cf{i}": np.random.random(1000) for i in range(5)}
+    jt.save_dict_to_shelve("results", arrays, foldername=shelve_folder)
+    jt.set_shelve_cache_size(3*8000)
+
+    for key, array in arrays.items():
+        assert np.array_equal(jt.retrieve_from_shelve("results", key, shelve_folder, cache=True), array)
+
+    info = jt.shelve_cache_info()
+    assert info['n_bytes'] <= 3*8000
+    assert info['n_objects'] < 5
+    jt.set_shelve_cache_size(1024**3)
+
+
+def test_background_writes_are_ordered_and_coalesced(shelve_folder):
+    futures = [jt.save_to_shelve("results", "cf", np.full(10, i), shelve_folder, background=True)
+               for i in range(20)]
+    futures.append(jt.save_dict_to_shelve("results", {"a": 1, "b": 2}, shelve_folder, background=True))
+
+    # Reading flushes the pending writes of the file
+    assert np.array_equal(jt.retrieve_from_shelve("results", "cf", shelve_folder), np.full(10, 19))
+    assert all(future.done() and future.exception() is None for future in futures)
+
+    jt.save_to_shelve("results", "a", 3, shelve_folder, background=True)
+    jt.flush_shelve_writes()
+    assert jt.retrieve_dict_from_shelve("results", shelve_folder)["a"] == 3
+
+
+def test_cancelled_background_write_is_dropped(shelve_folder, monkeypatch):
+    from jupytertools import utilities
+    started, release = threading.Event(), threading.Event()
+    write_shelve = utilities._write_shelve
+
+    def blocking_write(path, items):
+        if path.endswith("blocking"):
+            started.set()
+            release.wait()
+        write_shelve(path, items)
+
+    monkeypatch.setattr(utilities, "_write_shelve", blocking_write)
+    jt.save_to_shelve("blocking", "a", 1, shelve_folder, background=True)
+    assert started.wait(5)
+
+    kept = jt.save_to_shelve("results", "kept", 1, shelve_folder, background=True)
+    cancelled = jt.save_to_shelve("results", "cancelled", 2, shelve_folder, background=True)
+    assert cancelled.cancel()
+    release.set()
+
+    jt.flush_shelve_writes()
+    assert kept.done() and kept.exception() is None
+    assert jt.retrieve_dict_from_shelve("results", shelve_folder) == {"kept": 1}
+
+    # The writer keeps running after the cancelled future
+    jt.save_to_shelve("results", "later", 3, shelve_folder, background=True).result(timeout=5)
+
+
+def test_manifest_lists_without_reading(shelve_folder, capsys):
+    jt.save_dict_to_shelve("results", {"cf_a": np.zeros((4, 5), dtype=np.float32), "cf_b": np.zeros(3),
+                                       "meta": {"dt": 2}}, shelve_folder)
+
+    manifest = jt.read_manifest("results", shelve_folder)
+    assert manifest["cf_a"]["shape"] == [4, 5]
+    assert manifest["cf_a"]["dtype"] == "float32"
+    assert manifest["meta"]["type"] == "dict"
+    assert manifest["cf_a"]["nbytes"] > 80
+
+    assert jt.list_shelve("results", shelve_folder, pattern="cf_*") == ["cf_a", "cf_b"]
+    assert jt.list_shelve("results", shelve_folder, type_name="dict") == ["meta"]
+    assert sorted(jt.retrieve_dict_from_shelve("results", shelve_folder, pattern="cf_*")) == ["cf_a", "cf_b"]
+    assert jt.shelve_has_key("results", "meta", shelve_folder)
+    assert jt.is_stale("results", "missing", foldername=shelve_folder)
+
+    source = shelve_folder / "trajectory.dcd"
+    source.write_text("")
+    assert not jt.is_stale("results", "meta", foldername=shelve_folder)
+    jt.save_to_shelve("results", "meta", {"dt": 4}, shelve_folder)
+    assert not jt.is_stale("results", "meta", [source], foldername=shelve_folder)
+
+    jt.print_content_of_shelve("results", shelve_folder, details=True)
+    assert "cf_a: ndarray (4, 5) float32" in capsys.readouterr().out
+
+
+def test_manifest_rebuilt_after_external_change(shelve_folder, monkeypatch):
+    import pickle
+    import shelve
+
+    jt.save_to_shelve("results", "a", np.zeros(3), shelve_folder)
+    with shelve.open(str(shelve_folder / "results")) as database:
+        database["b"] = [1, 2]
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Listing must not unpickle the values")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(pickle, "loads", fail)
+        assert jt.list_shelve("results", shelve_folder) == ["a", "b"]
+        manifest = jt.read_manifest("results", shelve_folder)
+
+    assert manifest["a"]["type"] == "ndarray"
+    assert manifest["b"]["type"] is None
+    assert manifest["b"]["nbytes"] > 0
+    assert jt.read_manifest("results", shelve_folder, details=True)["b"]["type"] == "list"
+    assert jt.list_shelve("results", shelve_folder, type_name="list") == ["b"]
@@ -0,0 +1,60 @@
+import pytest
+
+import numpy as np
+import mdanalysis as md
+from jupytertools import arraystore
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_store_roundtrip_and_slices(tmp_path, compress):
+    array = np.random.random((103, 50))
+    arraystore.save_dict_to_store("results", {"cf/a b": array, "meta": {"dt": 2}},
+                                  foldername=tmp_path, chunk_length=10, compress=compress)
+
+    assert np.array_equal(arraystore.retrieve_from_store("results", "cf/a b", tmp_path), array)
+    assert arraystore.retrieve_from_store("results", "meta", tmp_path) == {"dt": 2}
+
+    lazy = arraystore.retrieve_from_store("results", "cf/a b", tmp_path, lazy=True, mmap=True)
+    assert lazy.shape == array.shape
+    assert np.array_equal(lazy[15:47:3, 5:], array[15:47:3, 5:])
+    assert np.array_equal(lazy[-1], array[-1])
+    assert np.array_equal(arraystore.retrieve_from_store("results", "cf/a b", tmp_path, index=[2, 99]),
+                          array[[2, 99]])
+
+    assert sorted(arraystore.retrieve_dict_from_store("results", tmp_path)) == ["cf/a b", "meta"]
+    with pytest.raises(KeyError):
+        arraystore.retrieve_from_store("results", "missing", tmp_path)
+
+
+@pytest.mark.parametrize("index", [slice(None, None, -1), [7, 1, 4], np.s_[8:2:-2], [5, 5, 0, 9]])
+def test_store_index_order_across_chunks(tmp_path, index):
+    array = np.arange(20).reshape(10, 2)
+    arraystore.save_to_store("results", "a", array, foldername=tmp_path, chunk_length=3)
+
+    assert np.array_equal(arraystore.retrieve_from_store("results", "a", tmp_path, index=index), array[index])
+
+
+def test_load_cf_from_store(tmp_path):
+    array = np.random.random((40, 200))
+    arraystore.save_to_store("results", "cf", array, foldername=tmp_path, chunk_length=7)
+
+    cf = md.load_cf("results", "cf", foldername=tmp_path, store=True)
+    assert cf._raw_stats == {}
+    assert all(isinstance(rows, np.memmap) for rows in cf._pending_rows)
+    assert cf.n_samples == 40
+    assert np.allclose(cf.average_cf, array.mean(axis=0))
+    assert np.allclose(cf.variance_cf, array.var(axis=0, ddof=1))
+    assert np.allclose(cf.cf_var, array)
+
+    cf_stats = md.load_cf("results", "cf", foldername=tmp_path, store=True, keep_samples=False)
+    assert np.allclose(cf_stats.variance_cf, array.var(axis=0, ddof=1))
+
+
+def test_load_cf_from_store_keeps_dtype(tmp_path):
+    array = np.random.random((30, 20)).astype(np.float32)
+    arraystore.save_to_store("results", "cf", array, foldername=tmp_path, chunk_length=8)
+
+    cf = md.load_cf("results", "cf", foldername=tmp_path, store=True)
+    assert all(rows.dtype == np.float32 for rows in cf._pending_rows)
+    assert cf.average_cf.dtype == np.float64
+    assert np.allclose(cf.average_cf, array.mean(axis=0, dtype=np.float64))
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import mdtraj as md
+from lammpstools import mdt
+
+
+def write_trajectory(folder, n_frames=20, n_atoms=4, seed=0):
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for _ in range(n_atoms):
+        residue = topology.add_residue('AR', chain)
+        topology.add_atom('Ar', md.element.argon, residue)
+
+    rng = np.random.default_rng(seed)
+    xyz = rng.random((n_frames, n_atoms, 3), dtype=np.float32)
+    traj = md.Trajectory(xyz, topology, time=np.arange(n_frames, dtype=float),
+                         unitcell_lengths=np.ones((n_frames, 3)), unitcell_angles=np.full((n_frames, 3), 90.0))
+
+    trajectory = os.path.join(folder, 'traj.xtc')
+    top = os.path.join(folder, 'top.pdb')
+    traj.save_xtc(trajectory)
+    traj[0].save_pdb(top)
+    return trajectory, top
+
+
+def test_load_traj_cache(tmp_path):
+    trajectory, top = write_trajectory(str(tmp_path))
+    cache_dir = str(tmp_path / 'cache')
+
+    direct = mdt.load_traj(trajectory, top, stride=2, atom_indices=[0, 2])
+    first = mdt.load_traj(trajectory, top, stride=2, atom_indices=[0, 2], cache=True, cache_dir=cache_dir)
+    second = mdt.load_traj(trajectory, top, stride=2, atom_indices=[0, 2], cache=True, cache_dir=cache_dir)
+
+    assert isinstance(second.xyz.base, np.memmap) or isinstance(second.xyz, np.memmap)
+    assert np.allclose(direct.xyz, second.xyz)
+    assert np.allclose(first.time, second.time)
+    assert second.n_atoms == 2
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 1
+
+
+def test_load_traj_cache_eviction(tmp_path):
+    trajectory, top = write_trajectory(str(tmp_path))
+    cache_dir = str(tmp_path / 'cache')
+
+    for stride in [1, 2, 3]:
+        mdt.load_traj(trajectory, top, stride=stride, cache=True, cache_dir=cache_dir, cache_size=1)
+
+    # Only the entry that was just written is kept
+    assert len([f for f in os.listdir(cache_dir) if f.endswith('.npy')]) == 1
+
+
+def wrap(xyz, box):
+    fractional = xyz @ np.linalg.inv(box)
+    return (fractional - np.floor(fractional)) @ box
+
+
+def test_unwrap_triclinic():
+    rng = np.random.default_rng(3)
+    box = np.array([[2.0, 0.0, 0.0], [0.5, 2.0, 0.0], [0.3, 0.4, 2.0]])
+    unwrapped = np.cumsum(rng.normal(scale=0.2, size=(50, 6, 3)), axis=0)
+    box_vectors = np.tile(box, (50, 1, 1))
+    wrapped = wrap(unwrapped, box)
+
+    result = mdt.unwrap(wrapped, box_vectors, chunk=7)
+
+    # Unwrapped trajectory is the original one shifted by a lattice vector
+    assert np.allclose(result - result[0], unwrapped - unwrapped[0])
+
+
+def test_unwrap_in_place_and_stream():
+    rng = np.random.default_rng(4)
+    box_vectors = np.tile(np.diag([1.5, 2.0, 2.5]), (40, 1, 1))
+    unwrapped = np.cumsum(rng.normal(scale=0.2, size=(40, 5, 3)), axis=0)
+    wrapped = wrap(unwrapped, box_vectors[0])
+
+    streamed = np.concatenate(list(mdt.unwrap_stream(
+        (wrapped[i:i+9], box_vectors[i:i+9]) for i in range(0, 40, 9))))
+    in_place = mdt.unwrap(wrapped, box_vectors, chunk=6, out=wrapped)
+
+    assert in_place is wrapped
+    assert np.allclose(in_place, streamed)
+    assert np.allclose(in_place - in_place[0], unwrapped - unwrapped[0])
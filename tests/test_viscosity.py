@@ -0,0 +1,95 @@
+import pytest
+
+import numpy as np
+from lammpstools import viscosity
+
+
+def correlated_series(n_components=3, n_frames=600, seed=0):
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(size=(n_components, n_frames))
+    kernel = np.exp(-np.arange(20)/5.0)
+    return np.array([np.convolve(row, kernel, mode='same') for row in noise])
+
+
+@pytest.mark.parametrize("normalized", [True, False])
+def test_stress_acf_fft_matches_direct(normalized):
+    tensors = correlated_series()
+
+    direct = viscosity.stress_acf(tensors, 1, 1, upper=100, normalized=normalized, avg=False,
+                                  extended=True)
+    fft = viscosity.stress_acf(tensors, 1, None, upper=100, normalized=normalized, avg=False,
+                               extended=True, method='fft')
+
+    for direct_array, fft_array in zip(direct, fft):
+        assert direct_array.shape == fft_array.shape
+        assert np.allclose(direct_array, fft_array)
+
+
+def test_stress_acf_fft_batch():
+    pxy, pxz, pyz, pxx, pyy, pzz = correlated_series(n_components=6)
+    tensors = viscosity.stress_batch(pxy, pxz, pyz, pxx, pyy, pzz)
+
+    assert tensors.shape == (5, 600)
+
+    direct = viscosity.stress_acf(tensors, 1, 1, upper=50)
+    fft = viscosity.stress_acf(tensors, 1, None, upper=50, method='fft')
+
+    assert np.allclose(direct, fft)
+
+
+def test_green_kubo_stream_file(tmp_path):
+    tensors = correlated_series(n_frames=500)
+    lines = ["# Time-averaged data for fix stress\n", "# TimeStep v_pxy v_pxz v_pyz\n"]
+    lines += ["{:d} {:.10f} {:.10f} {:.10f}\n".format(i, *row) for i, row in enumerate(tensors.T)]
+    stress_file = tmp_path / 'stress.dat'
+
+    # File is fed while it is being written, including a partially written line
+    text = "".join(lines)
+    cut = len("".join(lines[:300])) + 5
+    stress_file.write_text(text[:cut])
+    estimator = viscosity.green_kubo_file(str(stress_file), 1, 40, columns=['v_pxy', 'v_pxz', 'v_pyz'])
+    assert estimator.n_samples == 298
+
+    stress_file.write_text(text)
+    estimator.feed_file(str(stress_file))
+    assert estimator.n_samples == 500
+
+    expected = viscosity.stress_acf(np.round(tensors, 10), 1, None, upper=40, normalized=False, method='fft')
+    assert np.allclose(estimator.acf, expected)
+
+    integral = estimator.integral
+    assert np.isclose(integral[-1], np.trapezoid(expected) if hasattr(np, 'trapezoid') else np.trapz(expected))
+
+    value, start = estimator.plateau(window=5, tol=0.5)
+    assert np.isfinite(value) and start >= 0
+
+
+def test_viscosity_bootstrap():
+    tensors = correlated_series(n_frames=2000)
+
+    serial = viscosity.viscosity_bootstrap(tensors, 1, 200, upper=30, n_boot=200, max_workers=1, seed=1)
+    pooled = viscosity.viscosity_bootstrap(tensors, 1, 200, upper=30, n_boot=200, max_workers=2, seed=1)
+
+    for key in serial:
+        assert np.allclose(serial[key], pooled[key])
+
+    assert serial['block_integrals'].shape == (10, 30)
+    assert (serial['lower'] <= serial['upper']).all()
+    assert serial['viscosity_stderr'] > 0
+    assert abs(serial['viscosity'] - serial['block_integrals'][:, -1].mean()) < 3*serial['block_stderr'][-1]
+
+
+def test_einstein_helfand():
+    tensors = correlated_series(n_frames=20000)
+
+    x_fft, msd_fft = viscosity.einstein_helfand(tensors, 1, None, upper=200, avg=False)
+    _, msd_direct = viscosity.einstein_helfand(tensors, 1, upper=200, avg=False, method='direct')
+    assert msd_fft.shape == (3, 200)
+    assert np.allclose(msd_fft, msd_direct)
+
+    # Consistent with the plateau of the Green-Kubo integral
+    x_axis, msd = viscosity.einstein_helfand(tensors, 1, None, upper=200)
+    eta_helfand = viscosity.helfand_viscosity(x_axis, msd, 100, 200)
+    acf = viscosity.stress_acf(tensors, 1, None, upper=100, normalized=False, method='fft')
+    eta_green_kubo = acf[0]/2 + acf[1:].sum()
+    assert abs(eta_helfand - eta_green_kubo) < 0.15*eta_green_kubo